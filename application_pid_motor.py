@@ -20,7 +20,6 @@ Color = sim.Color
 
 sim.init(width=1600, height=800, scale=1)
 s = sim.state.scale
-frame_update = utils.FpsCounter(update_interval_sec=1/INTENDED_FPS)
 fps = utils.FpsCounter()
 
 mov_reference = interactive.Movable(shapes.Circle, [0.5, 0.5],
@@ -34,6 +33,9 @@ def ref_to_angle():
     return ret
 
 d_t = 1/INTENDED_FPS
+# the process is updated once every d_t of simulation time, no matter how fast
+# the frames are drawn
+sim.get_clock().set(tick=d_t)
 K_t = .0182
 K_e = .0182
 R = 0.83 
@@ -321,7 +323,7 @@ def process(d_t, voltage, oangl, oangl_speed, oangl_acc):
 
 # this function will be called each update cicle in the main loop to update
 # graphs and the representation of the motor
-def update_fn():
+def update_fn(dt):
     st = sim_state
     if not st.time:
         st.time = 0
@@ -330,9 +332,9 @@ def update_fn():
     voltage = regulator(st.time, st.angle, st.ref_angle)
     step_cnt = 1000
     for i in range(step_cnt):
-        st.angle, st.angl_speed, st.angl_acc = process(d_t/step_cnt, voltage,
+        st.angle, st.angl_speed, st.angl_acc = process(dt/step_cnt, voltage,
                 st.angle, st.angl_speed, st.angl_acc)
-    st.time += d_t
+    st.time += dt
 
 # Draw area(the student can ignore the next part):
 # ============================================================================== 
@@ -348,14 +350,15 @@ def draw_axis():
     # sim.draw_line([0, 0], [-s,0], Color.BLACK)
     pass
 
-def draw_motor():
-    MOTOR_WIDTH = 0.15
-    AXIS_RADIUS = 0.02
-    ROD_LENGTH = 0.6
-    ROD_END_RADIUS = 0.05
-    PIN_SIZE = 0.04
-    PIN_DISTANCE = 0.16
+MOTOR_WIDTH = 0.15
+AXIS_RADIUS = 0.02
+ROD_LENGTH = 0.6
+ROD_END_RADIUS = 0.05
+PIN_SIZE = 0.04
+PIN_DISTANCE = 0.16
 
+# the parts of the motor that never move
+def draw_motor_body():
     # Draw motor body 
     ui.TextLine("Motor", pos=[0, MOTOR_WIDTH],
             align=(ui.XCENTER, ui.YBOTTOM)).draw()
@@ -378,6 +381,12 @@ def draw_motor():
     
     # Draw motor axis
     sim.draw_circle([0, 0], AXIS_RADIUS)
+
+static_border = sim.StaticMesh(draw_border)
+static_motor_body = sim.StaticMesh(draw_motor_body)
+
+def draw_motor():
+    static_motor_body.draw()
     
     # Draw motor rod
     rod_end_dir = glm.vec2(
@@ -389,6 +398,8 @@ def draw_motor():
     sim.draw_circle(rod_end_dir * (AXIS_RADIUS + ROD_LENGTH + ROD_END_RADIUS),
             ROD_END_RADIUS, color=Color.RED, filled=True)
 
+info_block = ui.TextBlock('', pos_px=(5, 5), limits_px=(195, 795))
+
 def draw_info_text():
     info_text = '\n'.join([
         'App info state:',
@@ -398,24 +409,15 @@ def draw_info_text():
         '> vcc: %.3f' % sim_state.vcc,
         '> ref: %.3f' % rad2deg(sim_state.ref_angle)
     ])
-    tb = ui.TextBlock(info_text, pos_px=(5, 5), limits_px=(195, 795))
-    tb.draw()
+    info_block.text = info_text
+    info_block.draw()
 
 def draw_fn():
     fps.update()
-    if frame_update.update():
-        if frame_update.fps < 1:
-            for i in range(round(1/frame_update.fps)):
-                update_fn()
-            print("Frame took longer than %fs to be updated (%fs)" %
-                    (d_t, 1/INTENDED_FPS*(1/frame_update.fps)))
-        else:
-            update_fn()
-
     angle_plot.draw()
-    draw_border()
+    static_border.draw()
     draw_axis()
     draw_info_text()
     draw_motor()
 
-sim.loop(draw_fn=draw_fn)
+sim.loop(draw_fn=draw_fn, update_fn=update_fn, max_fps=INTENDED_FPS)
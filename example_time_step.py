@@ -6,16 +6,25 @@ from pygame.locals import *
 Color = sim.Color
 
 TIME_STEP = 0.01
-time_state = sim.dotdict({
-    'time': 0,
-    'paused': True
-})
+FAST_SPEED = 10
 
 sim.init(width=800, height=800, scale=1)
 s = sim.state.scale
 
-def increment_time():
-    time_state.time += TIME_STEP
+clock = sim.get_clock()
+clock.set(tick=TIME_STEP)
+clock.pause()
+
+# the state of the simulation at the last two ticks, the drawing is done
+# between them
+sim_state = sim.dotdict({
+    'angle': 0,
+    'prev_angle': 0
+})
+
+def update_fn(dt):
+    sim_state.prev_angle = sim_state.angle
+    sim_state.angle += dt
 
 def draw_axis():
     sim.draw_line([0, 0], [s, 0], Color.RED)
@@ -27,15 +36,16 @@ def event_fn(event):
     # http://www.pygame.org/docs/ref/key.html 
     if event.type == KEYDOWN:
         if event.key == K_p:
-            time_state.paused = not time_state.paused
-        if time_state.paused and event.key == K_n:
-            increment_time()
+            clock.toggle_pause()
+        if clock.paused and event.key == K_n:
+            clock.step()
+        if event.key == K_f:
+            clock.set(speed=FAST_SPEED if clock.speed == 1 else 1)
 
 def draw_fn():
-    if not time_state.paused:
-        increment_time()
     draw_axis()
-    t = time_state.time
-    sim.draw_circle([np.cos(t) / 2, np.sin(t) / 2], 0.1)
+    a = sim_state.prev_angle + \
+            (sim_state.angle - sim_state.prev_angle) * clock.alpha
+    sim.draw_circle([np.cos(a) / 2, np.sin(a) / 2], 0.1)
 
-sim.loop(draw_fn=draw_fn, event_fn=event_fn)
+sim.loop(draw_fn=draw_fn, event_fn=event_fn, update_fn=update_fn, max_fps=60)
@@ -3,7 +3,6 @@ import shapes
 import ui
 import copy
 import time
-import pygame
 
 import glm
 
@@ -293,10 +292,17 @@ class Graph:
             else:
                 to_draw.append(self._d2win(intr[0]))
                 to_draw.append(self._d2win(p2.P))
-        for i in range(len(to_draw)):
-            to_draw[i] = sim.pos2screen(to_draw[i])
-        pygame.draw.lines(sim.state.surface, self.color, False,
-                to_draw)
+        # to_draw holds the ends of each segment, the segments that follow one
+        # another are joined in a single polyline
+        lines = []
+        for i in range(0, len(to_draw) - 1, 2):
+            p1 = (to_draw[i].x, to_draw[i].y)
+            p2 = (to_draw[i + 1].x, to_draw[i + 1].y)
+            if not lines or lines[-1][-1] != p1:
+                lines.append([p1])
+            lines[-1].append(p2)
+        for line in lines:
+            sim.draw_polyline(line, self.color)
 
     def is_inside(self, P):
         if self.parent_plot.DA.x <= P.x and self.parent_plot.DA.y <= P.y:
@@ -269,3 +269,28 @@ class Point(Shape):
 
     def translate_origin(self, diff):
         self.P += glm.vec2(diff)
+
+# draws a list of shapes, circles, AABBs and points are grouped by type and
+# drawn with sim.draw_instanced, the rest are drawn one by one
+# * the grouped shapes are drawn after the rest, so don't use this if the
+# drawing order of overlapping shapes matters
+def draw_many(shape_list):
+    groups = {}
+    for sh in shape_list:
+        if isinstance(sh, Circle):
+            kind, center, size = sim.INSTANCE_CIRCLE, sh.C, (sh.r, sh.r)
+        elif isinstance(sh, Point):
+            r = POINT_RELATIVE_SIZE * sim.state.scale
+            kind, center, size = sim.INSTANCE_CIRCLE, sh.P, (r, r)
+        elif isinstance(sh, AABB):
+            AA, BB = intersect._aabb_fix(sh.AA, sh.BB)
+            kind, center, size = sim.INSTANCE_BOX, (AA + BB) / 2, (BB - AA) / 2
+        else:
+            sh.draw()
+            continue
+        group = groups.setdefault((kind, bool(sh.filled)), ([], [], []))
+        group[0].append((center.x, center.y))
+        group[1].append((size[0], size[1]))
+        group[2].append(tuple(sh.color))
+    for (kind, filled), (centers, sizes, colors) in groups.items():
+        sim.draw_instanced(kind, centers, sizes, 0, colors, filled)
@@ -5,11 +5,15 @@ import numpy as np
 from pygame.locals import *
 import pygame.freetype
 import os
+import contextlib
+import hashlib
+import time
 
 # sys.path.append(SIM_PKG_DIR)
 
 import sim_utils
 import intersect
+import utils
 
 # Defines:
 # ==============================================================================
@@ -17,6 +21,26 @@ import intersect
 SIM_PKG_DIR = os.path.dirname(__file__)
 SIM_FONT_NAME = os.path.join(SIM_PKG_DIR, "font/static/FiraCode-Regular.ttf")
 SIM_FONT_SIZE = 16
+# the number of rendered text surfaces kept by the software renderer
+SIM_TEXT_CACHE_SIZE = 512
+# above this many dirty rects per frame we present their union instead
+SIM_DIRTY_MAX_RECTS = 64
+# things closer than this to the edge of the screen are not culled
+SIM_CULL_MARGIN_PX = 2
+# the simulation time of one update of the clock, in seconds
+SIM_TICK = 1 / 100
+# a frame never advances the clock by more than this much real time, so a slow
+# frame doesn't leave the updates behind forever
+SIM_MAX_FRAME_DT = 0.25
+# the frame cap sleeps until this close to the end of the frame and waits the
+# rest without sleeping, sleep is not precise enough for the last part
+SIM_SLEEP_MARGIN = 0.002
+# the profiler overlay text is refreshed this often, in seconds
+SIM_PROFILE_OVERLAY_INTERVAL = 0.25
+# linked shader programs are saved here and loaded on the next start instead of
+# being compiled again, set to None to always compile from source
+SIM_SHADER_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache",
+        "phy_sim", "shaders")
 
 DEFAULT_VERTEX_SHADER = """
 #version 330
@@ -26,10 +50,12 @@ in vec4 color;
 in vec3 normal;
 in vec2 tex_uv;
 
+uniform mat4 view;
+
 out vec4 vert_color;
 
 void main() {
-    gl_Position = position;
+    gl_Position = view * position;
     vert_color = color;
 }
 """
@@ -45,6 +71,66 @@ void main() {
 }
 """
 
+# used by the instanced primitives, the mesh is scaled, rotated and moved by the
+# per instance attributes
+INSTANCE_VERTEX_SHADER = """
+#version 330
+
+in vec2 position;
+in vec2 inst_center;
+in vec2 inst_scale;
+in float inst_rotation;
+in vec4 inst_color;
+
+uniform mat4 view;
+
+out vec4 vert_color;
+
+void main() {
+    float c = cos(inst_rotation);
+    float s = sin(inst_rotation);
+    vec2 p = position * inst_scale;
+    p = vec2(c * p.x - s * p.y, s * p.x + c * p.y) + inst_center;
+    gl_Position = view * vec4(p, 0, 1);
+    vert_color = inst_color;
+}
+"""
+
+# used for text, the glyphs are taken from a sim_utils.GlyphAtlas, and for
+# surfaces, drawn in white, the positions are in pixels
+TEXT_VERTEX_SHADER = """
+#version 330
+
+in vec4 position;
+in vec4 color;
+in vec2 tex_uv;
+
+uniform mat4 screen;
+
+out vec4 vert_color;
+out vec2 vert_uv;
+
+void main() {
+    gl_Position = screen * position;
+    vert_color = color;
+    vert_uv = tex_uv;
+}
+"""
+
+TEXT_FRAGMENT_SHADER = """
+#version 330
+
+in vec4 vert_color;
+in vec2 vert_uv;
+out vec4 frag_color;
+
+uniform sampler2D atlas;
+
+void main() {
+    frag_color = vert_color * texture(atlas, vert_uv);
+}
+"""
+
 # Utils:
 # ==============================================================================
 
@@ -66,10 +152,134 @@ Color = sim_utils.Color
 
 SimFont = sim_utils.SimFont
 
-def create_shader(vs_data, fs_data):
+SIM_VERT_FORMAT_FULL = sim_utils.SIM_VERT_FORMAT_FULL
+SIM_VERT_FORMAT_2D = sim_utils.SIM_VERT_FORMAT_2D
+SIM_VERT_FORMAT_2D_UV = sim_utils.SIM_VERT_FORMAT_2D_UV
+
+CAPTURE_BLOCK = sim_utils.CAPTURE_BLOCK
+CAPTURE_DROP = sim_utils.CAPTURE_DROP
+
+# a linked shader program, it is also the program id so it can be given to any
+# gl function that expects one
+# - uniforms are looked up once and `set` only uploads values that changed
+class Shader(int):
+    def __new__(cls, program, vert_format, source_hash, gl):
+        return super().__new__(cls, program)
+
+    def __init__(self, program, vert_format, source_hash, gl):
+        self.vert_format = vert_format
+        self.source_hash = source_hash
+        self.gl = gl
+        # name: (location, setter, element count, numpy dtype)
+        self.uniforms = {}
+        self.values = {}
+        setters = _uniform_setters(gl)
+        for i in range(gl.glGetProgramiv(self, gl.GL_ACTIVE_UNIFORMS)):
+            name, size, gl_type = gl.glGetActiveUniform(self, i)
+            name = name.decode()
+            loc = gl.glGetUniformLocation(self, name)
+            # uniforms inside blocks don't have a location
+            if loc < 0 or gl_type not in setters:
+                continue
+            if name.endswith('[0]'):
+                name = name[:-3]
+            setter, dtype = setters[gl_type]
+            self.uniforms[name] = (loc, setter, int(size), dtype)
+
+    # - value is a number, a glm vector or matrix or anything numpy can turn
+    # into an array of the right size, vectors can also be given as separate
+    # components: shader.set('mouse_pos', x, y)
+    # - uniforms that are not used by the shader are ignored, like opengl does
+    def set(self, name, *value):
+        uniform = self.uniforms.get(name)
+        if not uniform:
+            return
+        loc, setter, size, dtype = uniform
+        value = value[0] if len(value) == 1 else value
+        # numpy reads glm matrices by rows, but opengl wants the columns
+        if hasattr(value, 'to_list'):
+            value = value.to_list()
+        data = np.ascontiguousarray(value, dtype=dtype).ravel()
+        key = data.tobytes()
+        if self.values.get(name) == key:
+            return
+        self.values[name] = key
+        _queue_close()
+        if state.gl_queue:
+            # the geometry already queued must see the old value
+            _queue_call(lambda: self._upload(loc, setter, size, data),
+                    barrier=self)
+        else:
+            self._upload(loc, setter, size, data)
+            self.gl.glUseProgram(state.gl_curr_shader or 0)
+
+    def _upload(self, loc, setter, size, data):
+        self.gl.glUseProgram(self)
+        setter(loc, size, data)
+
+    def get_location(self, name):
+        uniform = self.uniforms.get(name)
+        return uniform[0] if uniform else -1
+
+_uniform_setters_cache = {}
+
+# {gl type: (fn(location, count, data), dtype)}
+def _uniform_setters(gl):
+    if _uniform_setters_cache:
+        return _uniform_setters_cache
+    def matrix(fn):
+        return lambda loc, cnt, data: fn(loc, cnt, False, data)
+    for types, dtype, fns in [
+            ((gl.GL_FLOAT, gl.GL_FLOAT_VEC2, gl.GL_FLOAT_VEC3,
+                gl.GL_FLOAT_VEC4), np.float32, (gl.glUniform1fv,
+                gl.glUniform2fv, gl.glUniform3fv, gl.glUniform4fv)),
+            ((gl.GL_INT, gl.GL_INT_VEC2, gl.GL_INT_VEC3, gl.GL_INT_VEC4),
+                np.int32, (gl.glUniform1iv, gl.glUniform2iv,
+                gl.glUniform3iv, gl.glUniform4iv)),
+            ((gl.GL_BOOL, gl.GL_BOOL_VEC2, gl.GL_BOOL_VEC3, gl.GL_BOOL_VEC4),
+                np.int32, (gl.glUniform1iv, gl.glUniform2iv,
+                gl.glUniform3iv, gl.glUniform4iv)),
+            ((gl.GL_UNSIGNED_INT,), np.uint32, (gl.glUniform1uiv,)),
+            ((gl.GL_SAMPLER_1D, gl.GL_SAMPLER_2D, gl.GL_SAMPLER_3D,
+                gl.GL_SAMPLER_CUBE), np.int32, (gl.glUniform1iv,) * 4),
+            ((gl.GL_FLOAT_MAT2, gl.GL_FLOAT_MAT3, gl.GL_FLOAT_MAT4),
+                np.float32, (matrix(gl.glUniformMatrix2fv),
+                matrix(gl.glUniformMatrix3fv),
+                matrix(gl.glUniformMatrix4fv)))]:
+        for gl_type, fn in zip(types, fns):
+            _uniform_setters_cache[gl_type] = (fn, dtype)
+    return _uniform_setters_cache
+
+# vert_format is the layout of the vertices the shader will receive from the
+# batches, see sim_utils.VertFormat, the inputs of the shader that are not part
+# of the format will have their default value
+# - the positions are in the coord space, the shader can move them on the
+# screen with `uniform mat4 view`, or with `uniform mat4 screen` for positions
+# in pixels, both are kept up to date by sim
+# - the same sources always give back the same Shader, so calling this more
+# than once doesn't compile the program again
+def create_shader(vs_data, fs_data, vert_format=SIM_VERT_FORMAT_2D):
     gl = state.gl
     if not gl:
         raise Exception("Can't use this function without opengl")
+    source_hash = hashlib.sha1(
+            (vs_data + '\0' + fs_data).encode()).hexdigest()
+    key = (source_hash, vert_format.name)
+    if key in state.gl_shaders:
+        return state.gl_shaders[key]
+    program = _load_program_binary(source_hash)
+    if program is None:
+        program = _compile_program(vs_data, fs_data)
+        _save_program_binary(program, source_hash)
+    shader = Shader(program, vert_format, source_hash, gl)
+    state.gl_shaders[key] = shader
+    state.gl_shader_formats[shader] = vert_format
+    sim_utils.attrib_locations(gl, shader)
+    _set_view(shader)
+    return shader
+
+def _compile_program(vs_data, fs_data):
+    gl = state.gl
     from OpenGL.GL import shaders
     import OpenGL
     try: 
@@ -78,13 +288,105 @@ def create_shader(vs_data, fs_data):
     except OpenGL.GL.shaders.ShaderCompilationError as e:
         # TODO: nicer error somehow
         raise e
-    return shaders.compileProgram(vs, fs)
+    program = gl.glCreateProgram()
+    gl.glAttachShader(program, vs)
+    gl.glAttachShader(program, fs)
+    if _program_binaries_supported():
+        gl.glProgramParameteri(program, gl.GL_PROGRAM_BINARY_RETRIEVABLE_HINT,
+                gl.GL_TRUE)
+    gl.glLinkProgram(program)
+    gl.glDetachShader(program, vs)
+    gl.glDetachShader(program, fs)
+    gl.glDeleteShader(vs)
+    gl.glDeleteShader(fs)
+    if gl.glGetProgramiv(program, gl.GL_LINK_STATUS) != gl.GL_TRUE:
+        log = gl.glGetProgramInfoLog(program)
+        gl.glDeleteProgram(program)
+        raise Exception("Shader link failed: %s" % log)
+    return program
+
+def _program_binaries_supported():
+    gl = state.gl
+    return bool(SIM_SHADER_CACHE_DIR) and bool(gl.glProgramBinary) and \
+            gl.glGetIntegerv(gl.GL_NUM_PROGRAM_BINARY_FORMATS) > 0
+
+# the binaries only work with the driver that made them
+def _program_binary_path(source_hash):
+    gl = state.gl
+    driver = b'\0'.join([gl.glGetString(gl.GL_VENDOR),
+            gl.glGetString(gl.GL_RENDERER), gl.glGetString(gl.GL_VERSION)])
+    key = hashlib.sha1(source_hash.encode() + b'\0' + driver).hexdigest()
+    return os.path.join(SIM_SHADER_CACHE_DIR, key + ".bin")
+
+# returns the linked program or None if there is no usable binary, the file
+# starts with the binary format as an uint32, followed by the binary
+def _load_program_binary(source_hash):
+    if not _program_binaries_supported():
+        return None
+    import OpenGL.error
+    gl = state.gl
+    path = _program_binary_path(source_hash)
+    try:
+        data = np.fromfile(path, dtype=np.uint8)
+    except OSError:
+        return None
+    if len(data) <= 4:
+        return None
+    binary_format = int(data[:4].view(np.uint32)[0])
+    binary = data[4:]
+    program = gl.glCreateProgram()
+    # a driver update can make the old binaries useless and a corrupt file can
+    # have a format the driver doesn't know, which is an error instead of a
+    # failed link
+    try:
+        gl.glProgramBinary(program, binary_format, binary, len(binary))
+        linked = gl.glGetProgramiv(program, gl.GL_LINK_STATUS) == gl.GL_TRUE
+    except OpenGL.error.GLError:
+        linked = False
+    if not linked:
+        gl.glDeleteProgram(program)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    return program
+
+def _save_program_binary(program, source_hash):
+    if not _program_binaries_supported():
+        return
+    gl = state.gl
+    size = gl.glGetProgramiv(program, gl.GL_PROGRAM_BINARY_LENGTH)
+    if size <= 0:
+        return
+    binary = np.empty(size, dtype=np.uint8)
+    length = gl.GLsizei()
+    binary_format = gl.GLenum()
+    gl.glGetProgramBinary(program, size, length, binary_format, binary)
+    path = _program_binary_path(source_hash)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        os.makedirs(SIM_SHADER_CACHE_DIR, exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            f.write(np.uint32(binary_format.value).tobytes())
+            f.write(binary[:length.value].tobytes())
+        # other processes never see a half written file
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
 
 # Screen and state:
 # ==============================================================================
 
 state = None
-def init(width, height, scale=1, use_opengl=False, vsync=None):
+# - headless renders to an offscreen surface instead of a window, for batch
+# runs and tests, the frame can be read with `get_frame` and the simulation
+# driven with `run_frames`
+# - dirty_rects makes the software renderer clear and present only the parts
+# of the screen that were drawn on in this frame or in the last one, it is
+# ignored with opengl
+def init(width, height, scale=1, use_opengl=False, vsync=None,
+        headless=False, dirty_rects=False):
     global state
     state = dotdict({
         'width':             width,
@@ -100,15 +402,58 @@ def init(width, height, scale=1, use_opengl=False, vsync=None):
         'gl':                None,
         'gl_triangle_batch': None,
         'gl_line_batch':     None,
+        'gl_strip_batch':    None,
+        'gl_batches':        {},
+        'gl_shaders':        {},
+        'gl_shader_formats': {},
         'gl_curr_shader':    None,
-        'gl_def_shader':     None
+        'gl_def_shader':     None,
+        'gl_inst_shader':    None,
+        'gl_inst_batches':   {},
+        'gl_text_shader':    None,
+        'gl_text_batches':   {},
+        'gl_surf_textures':  None,
+        'gl_surf_batch':     None,
+        'gl_queue':          [],
+        'gl_run':            None,
+        'layer':             0,
+        'text_cache':        sim_utils.LRUCache(SIM_TEXT_CACHE_SIZE),
+        'recording':         None,
+        'headless':          headless,
+        'gl_frame':          None,
+        'capture':           None,
+        'dirty_rects':       None,
+        'prev_dirty_rects':  [],
+        'camera':            Camera(),
+        'clock':             Clock(),
+        'profiler':          sim_utils.Profiler(),
+        'profile_overlay':   None,
+        'profile_text_time': 0,
+        'stats':             sim_utils.FrameStats(),
+        'gpu_timer':         None,
+        'event_recorder':    None,
+        'view':              None,
+        'view_inv':          None,
+        'px_per_unit':       None,
+        'cull_bounds':       None,
+        'gl_view':           None,
+        'gl_screen':         None
     })
 
+    if headless:
+        # must be set before the video subsystem starts, a GL context still
+        # needs a (hidden) window, the offscreen driver can give us that
+        os.environ.setdefault("SDL_VIDEODRIVER",
+                "offscreen" if use_opengl else "dummy")
+        if use_opengl:
+            # the offscreen driver creates its context trough EGL
+            os.environ.setdefault("PYOPENGL_PLATFORM", "egl")
     pygame.init()
     state.font = load_font_size(SIM_FONT_SIZE)
     if state.width < state.height:
         print("WARNING: width can't be smaller than height, will clip height")
         state.height = state.width
+    _update_view()
     opt_args = {}
     if vsync is not None:
         opt_args["vsync"] = vsync
@@ -117,36 +462,64 @@ def init(width, height, scale=1, use_opengl=False, vsync=None):
         state.gl = gl
         state.surface = pygame.display.set_mode(
             (state.width, state.height),
-            DOUBLEBUF | OPENGL,
+            DOUBLEBUF | OPENGL | (HIDDEN if headless else 0),
             **opt_args
         )
         state.gl_def_shader = create_shader(
                 DEFAULT_VERTEX_SHADER, DEFAULT_FRAGMENT_SHADER)
+        state.gl_inst_shader = create_shader(
+                INSTANCE_VERTEX_SHADER, DEFAULT_FRAGMENT_SHADER)
+        state.gl_text_shader = create_shader(TEXT_VERTEX_SHADER,
+                TEXT_FRAGMENT_SHADER, vert_format=SIM_VERT_FORMAT_2D_UV)
         gl.glUseProgram(state.gl_def_shader)
         state.gl_curr_shader = state.gl_def_shader
-        state.gl_line_batch = sim_utils.LineBatch(state.gl_curr_shader, gl=gl)
-        state.gl_triangle_batch = sim_utils.TriangleBatch(
-                state.gl_curr_shader, gl=gl)
+        _use_gl_batches(state.gl_curr_shader)
+        state.gl_surf_textures = sim_utils.SurfaceTextures(gl=gl)
+        state.gl_surf_textures.flush_fn = draw_batch
+        state.gl_surf_batch = sim_utils.TriangleBatch(state.gl_text_shader,
+                gl=gl, vert_format=SIM_VERT_FORMAT_2D_UV)
+        state.gl_surf_batch.flush_fn = draw_batch
+        state.gpu_timer = sim_utils.GpuTimer(gl=gl)
         gl.glClearColor(1, 1, 1, 0)
         gl.glDisable(gl.GL_CULL_FACE);
         gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA) 
+    elif headless:
+        state.surface = pygame.Surface((state.width, state.height), 0, 32)
     else:
         state.surface = pygame.display.set_mode(
                 (state.width, state.height), 0, 32, **opt_args)
+    if dirty_rects and not use_opengl:
+        # the first frame clears and presents everything
+        state.dirty_rects = [state.surface.get_rect()]
     _interactive_init()
 
 def use_shader(new_shader):
     if not state.gl:
         raise Exception("can't change shaders if you don't use opengl")
-    state.gl_line_batch.draw()
-    state.gl_triangle_batch.draw()
-
-    state.gl_line_batch.bind_shader(new_shader)
-    state.gl_triangle_batch.bind_shader(new_shader)
-
+    # nothing is drawn here, the draw queue remembers the shader of the
+    # geometry added from now on
+    _queue_close()
+    _use_gl_batches(new_shader)
     state.gl_curr_shader = new_shader
     state.gl.glUseProgram(new_shader)
 
+# there is a set of line, triangle and strip batches for each vertex format,
+# the shader decides which set is used, shaders not created by `create_shader`
+# get the full format
+def _use_gl_batches(shader):
+    gl = state.gl
+    vert_format = state.gl_shader_formats.get(shader, SIM_VERT_FORMAT_FULL)
+    if vert_format not in state.gl_batches:
+        state.gl_batches[vert_format] = (
+            sim_utils.LineBatch(shader, gl=gl, vert_format=vert_format),
+            sim_utils.TriangleBatch(shader, gl=gl, vert_format=vert_format),
+            sim_utils.StripBatch(shader, gl=gl, vert_format=vert_format)
+        )
+        for batch in state.gl_batches[vert_format]:
+            batch.flush_fn = draw_batch
+    state.gl_line_batch, state.gl_triangle_batch, state.gl_strip_batch = \
+            state.gl_batches[vert_format]
+
 def load_font_size(size):
     if size in state.fonts:
         return state.fonts[size]
@@ -156,58 +529,267 @@ def load_font_size(size):
 
 def _intern_exit(exit_fn=_none_fn):
     global state
-    pygame.quit()
-    exit_fn()
-    state.alive = False
+    # the frames still in flight need the gl context, the window is closed
+    # even if the capture failed
+    try:
+        stop_capture()
+    finally:
+        stop_recording()
+        pygame.quit()
+        exit_fn()
+        state.alive = False
 
+# draws everything in the draw queue
 def draw_batch():
     gl = state.gl
-    if gl:
-        state.gl_line_batch.draw()
-        state.gl_triangle_batch.draw()
+    # the batches belong to a static mesh while it is being recorded
+    if not gl or state.recording:
+        return
+    run = state.gl_run
+    _queue_close()
+    if state.gl_queue:
+        runs = state.gl_queue
+        state.gl_queue = []
+        with state.profiler.scope('flush'):
+            _draw_runs(runs)
+        # the geometry of the open run is not drawn yet
+        state.gl_surf_textures.drawn(keep=run.texture if run else 0)
+    if run:
+        # the geometry added after this starts again from the beginning of the
+        # batch
+        state.gl_run = _Run(run.batch, run.shader, run.texture, run.blend,
+                run.layer, 0)
 
-def loop(draw_fn, event_fn=_none_fn, exit_fn=_none_fn):
+# - if capture_dir is set every frame is saved there, see `start_capture`
+# - update_fn(dt) is called before each frame for each tick of the clock that
+# passed, dt is the tick, see `Clock`
+# - max_fps caps the frame rate, same as `get_clock().set(max_fps=...)`, 0
+# removes the cap, without it the cap of the clock is kept
+# - if record_path is set the events are saved there, see `start_recording`
+# - if replay_path is set the events recorded there are used instead of the
+# ones of the window, with the same clock times, as fast as possible, the loop
+# ends with the recording and returns the utils.FrameTimes of the replay
+#
+# Example, to compare two versions on the same session:
+#   sim.loop(draw_fn, record_path='session.events.gz')
+#   # later, with sim.init(..., headless=True)
+#   times = sim.loop(draw_fn, replay_path='session.events.gz')
+#   print(times.stats())
+def loop(draw_fn, event_fn=_none_fn, exit_fn=_none_fn, capture_dir=None,
+        update_fn=None, max_fps=None, record_path=None, replay_path=None):
+    if capture_dir:
+        start_capture(capture_dir)
+    if record_path:
+        start_recording(record_path)
+    replay = None
+    if replay_path:
+        replay = _open_replay(replay_path)
+        frame_times = utils.FrameTimes(size=max(len(replay.frames), 1))
+    clock = state.clock
+    if max_fps is not None:
+        clock.set(max_fps=max_fps)
+    profiler = state.profiler
     while state.alive:
-        for event in pygame.event.get():
-            if event.type == QUIT:
+        frame_start = time.perf_counter()
+        with profiler.scope('frame'):
+            with profiler.scope('events'):
+                dt = None
+                if replay:
+                    frame = replay.next_frame()
+                    if frame is None:
+                        _intern_exit(exit_fn)
+                        break
+                    dt, events = frame
+                    # the window can still be closed during a replay
+                    events += [event for event in pygame.event.get()
+                            if event.type == QUIT]
+                else:
+                    events = pygame.event.get()
+                recorder = state.event_recorder
+                if recorder:
+                    recorder.add(events)
+                _handle_events(events, event_fn, exit_fn)
+            if not state.alive:
+                break
+            with profiler.scope('update'):
+                for i in range(clock._advance(dt)):
+                    if update_fn:
+                        update_fn(clock.tick)
+                    clock.time += clock.tick
+            if recorder:
+                recorder.end_frame(clock.frame_dt)
+            _draw_frame(draw_fn)
+            with profiler.scope('present'):
+                _present()
+            if replay:
+                frame_times.add(time.perf_counter() - frame_start)
+            else:
+                with profiler.scope('wait'):
+                    clock._wait()
+        profiler.end_frame()
+    if replay:
+        return frame_times
+
+def _handle_events(events, event_fn, exit_fn):
+    for event in events:
+        if event.type == QUIT:
+            _intern_exit(exit_fn)
+            break
+        if event.type == KEYDOWN:
+            if event.key == K_ESCAPE:
                 _intern_exit(exit_fn)
                 break
-            if event.type == KEYDOWN:
-                if event.key == K_ESCAPE:
-                    _intern_exit(exit_fn)
-                    break
 
-            if event.type == pygame.MOUSEMOTION:
-                pos = pygame.mouse.get_pos()
-                state.prev_mouse_pos = state.mouse_pos
-                state.mouse_pos = pos
-                _interactive_on_move(pos)
+        # the positions are taken from the events, not from the mouse, so a
+        # replay sees the same ones
+        if event.type == pygame.MOUSEMOTION:
+            pos = event.pos
+            state.prev_mouse_pos = state.mouse_pos
+            state.mouse_pos = pos
+            _interactive_on_move(pos)
 
-            if event.type == pygame.MOUSEBUTTONDOWN:
-                pos = pygame.mouse.get_pos()
-                _interactive_on_click(pos)
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            pos = event.pos
+            _interactive_on_click(pos)
 
-            if event.type == pygame.MOUSEBUTTONUP:
-                pos = pygame.mouse.get_pos()
-                _interactive_on_release(pos)
+        if event.type == pygame.MOUSEBUTTONUP:
+            pos = event.pos
+            _interactive_on_release(pos)
 
-            event_fn(event)
+        if event.type == pygame.WINDOWEXPOSED:
+            mark_dirty(state.surface.get_rect())
 
-        if not state.alive:
-            break
-        gl = state.gl
-        if gl:
-            gl.glClear(gl.GL_COLOR_BUFFER_BIT|gl.GL_DEPTH_BUFFER_BIT)
-        else:
-            state.surface.fill(Color.WHITE)
+        event_fn(event)
+
+# saves the events of each frame to path, with the real time each frame took,
+# so `loop` can replay them later, see sim_utils.EventRecorder
+def start_recording(path):
+    if state.event_recorder:
+        raise Exception("The events are already recorded")
+    state.event_recorder = sim_utils.EventRecorder(path,
+            {'width': state.width, 'height': state.height})
+
+# returns the number of frames that were recorded
+def stop_recording():
+    if not state.event_recorder:
+        return 0
+    recorder = state.event_recorder
+    state.event_recorder = None
+    recorder.close()
+    return recorder.frames
+
+def _open_replay(path):
+    replay = sim_utils.EventReplay(path)
+    size = (replay.header.get('width'), replay.header.get('height'))
+    if size != (state.width, state.height):
+        raise Exception("The events were recorded in a %sx%s window" % size)
+    return replay
+
+# draws n frames without looking at events, meant for headless runs, after each
+# frame `frame_fn` is called with the frame, as returned by `get_frame`
+def run_frames(n, draw_fn, frame_fn=None):
+    profiler = state.profiler
+    for i in range(n):
+        with profiler.scope('frame'):
+            _draw_frame(draw_fn)
+            if frame_fn:
+                frame_fn(get_frame())
+            with profiler.scope('present'):
+                _present()
+        profiler.end_frame()
+
+# returns the current frame as an (height, width, 3) uint8 array:
+# - without opengl this is a view of the surface, no copy is made, the surface
+# stays locked while the view is alive so drop it before drawing again
+# - with opengl the pixels are read back into a buffer that is reused between
+# calls, so copy the result if you need to keep it
+def get_frame():
+    draw_batch()
+    gl = state.gl
+    if not gl:
+        return pygame.surfarray.pixels3d(state.surface).swapaxes(0, 1)
+    if state.gl_frame is None:
+        state.gl_frame = np.empty((state.height, state.width, 3), np.uint8)
+    gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+    gl.glReadPixels(0, 0, state.width, state.height, gl.GL_RGB,
+            gl.GL_UNSIGNED_BYTE, state.gl_frame)
+    # opengl has the first row at the bottom
+    return state.gl_frame[::-1]
+
+def _draw_frame(draw_fn):
+    gl = state.gl
+    stats = sim_utils.frame_stats
+    stats.reset()
+    if gl:
+        state.gpu_timer.begin()
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT|gl.GL_DEPTH_BUFFER_BIT)
+    elif state.dirty_rects is not None:
+        # everything that is not white was drawn last frame inside those
+        state.prev_dirty_rects = _merge_dirty(state.dirty_rects)
+        state.dirty_rects = []
+        for rect in state.prev_dirty_rects:
+            state.surface.fill(Color.WHITE, rect)
+    else:
+        state.surface.fill(Color.WHITE)
+    profiler = state.profiler
+    with profiler.scope('interactive'):
         _interactive_on_draw()
         draw_batch()
+    with profiler.scope('draw'):
         draw_fn()
+        if state.profile_overlay:
+            _draw_profile_overlay()
         draw_batch()
-        if gl:
-            pygame.display.flip()
-        else:
-            pygame.display.update()
+    if gl:
+        stats.gpu_time = state.gpu_timer.end()
+    state.stats = stats.copy()
+
+# saves the frames that are drawn from now on to out_dir, the frames are
+# written by another thread, see sim_utils.FrameCapture for the formats:
+# - policy is either CAPTURE_BLOCK, the loop waits for the writer when
+# max_queue frames are waiting, or CAPTURE_DROP, the frame is skipped
+def start_capture(out_dir, fmt='png', max_queue=16, policy=CAPTURE_BLOCK):
+    if state.capture:
+        raise Exception("A capture is already running")
+    state.capture = sim_utils.FrameCapture(out_dir, state.width, state.height,
+            fmt=fmt, max_queue=max_queue, policy=policy, gl=state.gl)
+
+# returns the number of frames that were dropped, raises the error of the
+# writer if it failed
+def stop_capture():
+    if not state.capture:
+        return 0
+    capture = state.capture
+    state.capture = None
+    capture.close()
+    if capture.error:
+        raise capture.error
+    return capture.dropped
+
+def _present():
+    if state.capture:
+        state.capture.grab(state.surface)
+    if state.gl:
+        pygame.display.flip()
+    elif state.headless:
+        pass
+    elif state.dirty_rects is not None:
+        pygame.display.update(
+                _merge_dirty(state.prev_dirty_rects + state.dirty_rects))
+    else:
+        pygame.display.update()
+
+# tells the software renderer that rect (in pixels) was drawn on, the sim.draw_*
+# functions already do this, call it if you draw on sim.state.surface yourself
+def mark_dirty(rect):
+    if state.dirty_rects is None or state.recording:
+        return
+    state.dirty_rects.append(rect)
+
+def _merge_dirty(rects):
+    if len(rects) > SIM_DIRTY_MAX_RECTS:
+        return [rects[0].unionall(rects[1:])]
+    return rects
 
 # Input functions
 # ==============================================================================
@@ -240,39 +822,393 @@ def get_prev_mouse_pos():
 # 
 # where:
 #   s - scale
+# 
+# as seen by the default camera, see `Camera`
+
+# the transforms between the two spaces are kept in `state`, they are only
+# computed again when the view changes:
+# - view is a glm.dmat3 from the coord space to pixels, view_inv the reverse
+# - px_per_unit is the number of pixels in an unit of distance
+# - gl_view and gl_screen are the `view` and `screen` uniforms of the shaders,
+# they move positions from the coord space and from pixels to opengl
+# - cull_bounds is the box of the coord space that can be seen, as
+# (x0, y0, x1, y1), None when nothing should be culled
+def _update_view():
+    cam = state.camera
+    s = state.height / 2 / state.scale * cam.zoom
+    c, sn = np.cos(cam.rotation), np.sin(cam.rotation)
+    # the camera is moved to the origin and turned the other way
+    to_camera = glm.dmat3(
+        c, -sn, 0,
+        sn, c, 0,
+        -c * cam.center.x - sn * cam.center.y,
+        sn * cam.center.x - c * cam.center.y, 1)
+    state.view = glm.dmat3(
+        s, 0, 0,
+        0, -s, 0,
+        state.width / 2, state.height / 2, 1) * to_camera
+    state.view_inv = glm.inverse(state.view)
+    state.px_per_unit = s
+    # static meshes in opengl are recorded without culling
+    if not (state.gl and state.recording):
+        state.cull_bounds = _view_bounds()
+    px2gl = glm.dmat3(
+        2 / state.width, 0, 0,
+        0, -2 / state.height, 0,
+        -1, 1, 1)
+    state.gl_view = _gl_mat4(px2gl * state.view)
+    state.gl_screen = _gl_mat4(px2gl)
+    if state.gl:
+        # the geometry in the queue was placed with the old view
+        draw_batch()
+        for shader in state.gl_shaders.values():
+            _set_view(shader)
+    elif state.surface:
+        mark_dirty(state.surface.get_rect())
+
+# the box of the coord space that holds the screen, with a margin for the
+# lines that stick out of their shapes
+def _view_bounds():
+    corners = screen2pos_arr([(0, 0), (state.width, 0), (0, state.height),
+            (state.width, state.height)])
+    margin = SIM_CULL_MARGIN_PX / state.px_per_unit
+    lo = corners.min(axis=0) - margin
+    hi = corners.max(axis=0) + margin
+    return (lo[0], lo[1], hi[0], hi[1])
+
+# the 2d transform m as a mat4 that leaves z alone
+def _gl_mat4(m):
+    return glm.mat4(
+        m[0][0], m[0][1], 0, 0,
+        m[1][0], m[1][1], 0, 0,
+        0, 0, 1, 0,
+        m[2][0], m[2][1], 0, 1)
+
+def _set_view(shader):
+    shader.set('view', state.gl_view)
+    shader.set('screen', state.gl_screen)
 
 # transforms position from coord space to space coords
 def pos2screen(pos):
-    x = pos[0] / state.scale
-    y = pos[1] / state.scale
-    screen_x = (x + 1) * state.height / 2 + (state.width - state.height) / 2
-    screen_y = (1 - y) * state.height / 2
-    return (int(screen_x), int(screen_y))
+    p = state.view * glm.dvec3(pos[0], pos[1], 1)
+    return (int(p.x), int(p.y))
 
 def screen2pos(pos):
-    x = (pos[0] - (state.width - state.height) / 2) / state.height * 2 - 1
-    y = -pos[1] / state.height * 2 + 1
-    return (x * state.scale, y * state.scale)
+    p = state.view_inv * glm.dvec3(pos[0], pos[1], 1)
+    return (p.x, p.y)
 
 def dist2px(dist):
-    return int(dist / state.scale * state.height / 2)
+    return int(dist * state.px_per_unit)
 
 def px2dist(dist):
-    return dist * state.scale / state.height * 2
+    return dist / state.px_per_unit
+
+# array versions of the functions above, they take arrays of shape (..., 2)
+# and transform all the positions with one matrix product
+def pos2screen_arr(pos):
+    return _transform_arr(state.view, pos).astype(int)
+
+def screen2pos_arr(pos):
+    return _transform_arr(state.view_inv, pos)
+
+def _transform_arr(m, pos):
+    pos = np.asarray(pos, dtype=np.float64)
+    # the columns of m
+    m = np.array(m.to_list())
+    return pos @ m[:2, :2] + m[2, :2]
+
+# False if the box from posA to posB can't be seen on the screen, things that
+# are not seen are not drawn, in opengl they don't even reach the batches
+def in_view(posA, posB):
+    return not _outside_box(posA, posB)
+
+# the same test for two points, spelled out because draw_line and friends are
+# called a lot and max/min over tuples costs more than the drawing itself
+def _outside_box(posA, posB):
+    bounds = state.cull_bounds
+    if bounds is None:
+        return False
+    x0, y0, x1, y1 = bounds
+    ax = posA[0]
+    bx = posB[0]
+    if ax < x0 and bx < x0 or ax > x1 and bx > x1:
+        return True
+    ay = posA[1]
+    by = posB[1]
+    return ay < y0 and by < y0 or ay > y1 and by > y1
+
+def _outside_view(xs, ys):
+    bounds = state.cull_bounds
+    return bounds is not None and (max(xs) < bounds[0] or
+            min(xs) > bounds[2] or max(ys) < bounds[1] or min(ys) > bounds[3])
+
+# the mask of the items that can be seen, from the corners of their boxes lo
+# and hi, arrays of shape (N, 2), None if all of them can be seen
+def _view_mask(lo, hi):
+    bounds = state.cull_bounds
+    if bounds is None:
+        return None
+    keep = (hi[:, 0] >= bounds[0]) & (lo[:, 0] <= bounds[2]) & \
+            (hi[:, 1] >= bounds[1]) & (lo[:, 1] <= bounds[3])
+    return None if keep.all() else keep
+
+# returns the positions in the form expected by the gl batches
+def _pos2gl_arr(pos):
+    return np.asarray(pos, dtype=np.float32).reshape(-1, 2)
+
+# Camera:
+# ==============================================================================
+
+# The camera decides which part of the coord space is on the screen, the view
+# is computed again only when the camera is changed, with `set`, `pan` or
+# `zoom_at`:
+# - center is the position in the middle of the screen
+# - zoom makes everything bigger when above 1
+# - rotation is in radians, counterclockwise, the world seems to turn the other
+# way
+#
+# Example:
+#   cam = sim.get_camera()
+#   cam.zoom_at(sim.get_mouse_pos(), 1.1)
+class Camera:
+    def __init__(self):
+        self.center = Vec2(0, 0)
+        self.zoom = 1
+        self.rotation = 0
+
+    def set(self, center=None, zoom=None, rotation=None):
+        if center is not None:
+            self.center = Vec2(center)
+        if zoom is not None:
+            if zoom <= 0:
+                raise Exception("The zoom must be positive")
+            self.zoom = zoom
+        if rotation is not None:
+            self.rotation = rotation
+        _update_view()
+
+    # moves the camera by diff, in the coord space
+    def pan(self, diff):
+        self.set(center=self.center + Vec2(diff))
+
+    # zooms by factor while pos stays in the same place on the screen, for
+    # zooming at the mouse
+    def zoom_at(self, pos, factor):
+        pos = Vec2(pos)
+        self.set(center=pos + (self.center - pos) / factor,
+                zoom=self.zoom * factor)
+
+    def reset(self):
+        self.set(center=(0, 0), zoom=1, rotation=0)
+
+def get_camera():
+    return state.camera
+
+# Clock:
+# ==============================================================================
+
+# The clock keeps the simulation time apart from the frames, `loop` calls
+# update_fn once for each tick of simulation time that passed, whatever the
+# frame rate is:
+# - tick is the simulation time of one update, in seconds
+# - speed is how fast the simulation time passes compared to the real one, with
+# a big speed many ticks are done for each frame
+# - while paused no ticks are done, except for the ones asked for with `step`
+# - alpha is how far the simulation time is between the last tick and the next
+# one, in [0, 1), to interpolate the drawing between the two states
+# - max_fps caps the frame rate, the loop sleeps for the rest of the frame, 0
+# removes the cap, None (the default of `set`) leaves it as it is
+#
+# Example:
+#   clock = sim.get_clock()
+#   clock.set(tick=1/200, max_fps=60)
+#   sim.loop(draw_fn, update_fn=lambda dt: world.step(dt))
+class Clock:
+    def __init__(self):
+        self.tick = SIM_TICK
+        self.speed = 1
+        self.max_fps = None
+        self.paused = False
+        self.time = 0
+        self.alpha = 0
+        # the real time of the last frame, in seconds
+        self.frame_dt = 0
+        self._acc = 0
+        self._steps = 0
+        self._last = None
+        self._deadline = None
+
+    def set(self, tick=None, speed=None, max_fps=None):
+        if tick is not None:
+            if tick <= 0:
+                raise Exception("The tick must be positive")
+            self.tick = tick
+        if speed is not None:
+            if speed < 0:
+                raise Exception("The speed can't be negative")
+            self.speed = speed
+        if max_fps is not None:
+            if max_fps < 0:
+                raise Exception("max_fps can't be negative")
+            self.max_fps = max_fps if max_fps else None
+            self._deadline = None
+
+    def pause(self, paused=True):
+        self.paused = paused
+
+    def toggle_pause(self):
+        self.paused = not self.paused
+
+    # does n more ticks on the next frame, meant for stepping while paused
+    def step(self, n=1):
+        self._steps += n
+
+    # returns the number of ticks to do this frame, the time moves forward
+    # with each of them, dt is the real time of the frame when it is not
+    # measured (replays)
+    def _advance(self, dt=None):
+        now = time.perf_counter()
+        if dt is None:
+            dt = 0 if self._last is None else now - self._last
+        dt = min(dt, SIM_MAX_FRAME_DT)
+        self._last = now
+        self.frame_dt = dt
+        ticks = self._steps
+        self._steps = 0
+        if not self.paused:
+            self._acc += dt * self.speed
+            done = int(self._acc / self.tick)
+            self._acc -= done * self.tick
+            ticks += done
+        self.alpha = self._acc / self.tick
+        return ticks
+
+    # sleeps until the end of the frame, if there is a frame cap
+    def _wait(self):
+        if not self.max_fps:
+            return
+        now = time.perf_counter()
+        deadline = None if self._deadline is None else \
+                self._deadline + 1 / self.max_fps
+        if deadline is None or now > deadline:
+            # the frame is late, catching up would run frames back to back
+            self._deadline = now
+            return
+        self._deadline = deadline
+        left = deadline - now
+        if left > SIM_SLEEP_MARGIN:
+            time.sleep(left - SIM_SLEEP_MARGIN)
+        while time.perf_counter() < deadline:
+            pass
+
+def get_clock():
+    return state.clock
+
+# Profiling:
+# ==============================================================================
+
+# `loop` times each part of the frame: 'events', 'update', 'interactive',
+# 'draw', 'flush' (the opengl draw queue, also inside 'draw'), 'present' and
+# 'wait' (the frame cap), all of them inside 'frame'. Your own code can be
+# timed the same way:
+#
+# Example:
+#   with sim.profile('physics'):
+#       world.step(dt)
+def profile(name):
+    return state.profiler.scope(name)
+
+# returns {name: (last, avg, max)}, the times of each scope in seconds, over
+# the last sim_utils.SIM_PROFILE_FRAMES frames
+def get_profile():
+    return state.profiler.stats()
+
+# shows the times of each scope in the top right corner of the screen
+def show_profile(show=True):
+    if not show:
+        state.profile_overlay = None
+        return
+    # ui imports sim
+    import ui
+    # a narrow window gets narrower lines instead of text off the screen
+    width = min(31 * state.font.char_width_px(), state.width - 10)
+    state.profile_overlay = ui.TextBlock('',
+            pos_px=(max(state.width - width - 5, 0), 5),
+            limits_px=(width, state.height))
+    state.profile_text_time = 0
+
+# writes the scopes of the next n frames to path, as a chrome trace (json)
+def trace_frames(path, n=60):
+    state.profiler.start_trace(path, n)
+
+# returns the sim_utils.FrameStats of the last frame, the draw calls,
+# primitives and bytes sent to opengl, gpu_time is the time the gpu took for
+# the newest frame it finished, one or two frames before that one
+def get_stats():
+    return state.stats
+
+def _draw_profile_overlay():
+    overlay = state.profile_overlay
+    now = time.perf_counter()
+    # new text every frame would go trough the text caches each time
+    if now - state.profile_text_time > SIM_PROFILE_OVERLAY_INTERVAL:
+        state.profile_text_time = now
+        lines = ['%-12s %8s %8s' % ('ms', 'avg', 'max')]
+        for name, (last, avg, max_dt) in state.profiler.stats().items():
+            lines.append('%-12s %8.2f %8.2f' % (name, avg * 1000,
+                    max_dt * 1000))
+        stats = state.stats
+        if stats.gpu_time is not None:
+            lines.append('%-12s %8.2f' % ('gpu', stats.gpu_time * 1000))
+        if state.gl:
+            lines.append('draws %d tris %d lines %d' % (stats.draw_calls,
+                    stats.triangles, stats.lines))
+            lines.append('upload %.1fKB textures %d' % (
+                    stats.upload_bytes / 1024, stats.texture_uploads))
+        overlay.text = '\n'.join(lines)
+    # a white box behind the text so it can be read over the scene
+    x0, y0 = overlay.pos_px
+    x1 = x0 + overlay.limits_px[0]
+    y1 = y0 + len(overlay.text.splitlines()) * state.font.char_height_px()
+    draw_quad(screen2pos((x0, y0)), screen2pos((x1, y0)),
+            screen2pos((x1, y1)), screen2pos((x0, y1)), Color.WHITE,
+            filled=True)
+    overlay.draw()
 
 # Drawing primitives:
 # ==============================================================================
 
 def draw_line(posA, posB, color=Color.BLACK):
+    if _outside_box(posA, posB):
+        return
     if state.gl:
-        posA = Vec4(posA[0], posA[1], 0, state.scale) / state.scale
-        posB = Vec4(posB[0], posB[1], 0, state.scale) / state.scale
-        state.gl_line_batch.add_line(
-                Vert(posA, color), Vert(posB, color))
+        _gl_lines().add(((posA[0], posA[1]), (posB[0], posB[1])), color)
     else:
         posA = pos2screen(posA)
         posB = pos2screen(posB)
-        pygame.draw.line(state.surface, color, posA, posB)
+        mark_dirty(pygame.draw.line(state.surface, color, posA, posB))
+
+# points - array of shape (N, 2), the line goes trough them in order, if
+# closed the last point is connected to the first
+def draw_polyline(points, color=Color.BLACK, closed=False):
+    points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+    if len(points) < 2:
+        return
+    if _outside_box(points.min(axis=0), points.max(axis=0)):
+        return
+    if state.gl:
+        if closed:
+            points = np.concatenate([points, points[:1]])
+        if state.recording:
+            # static meshes only keep lines and triangles
+            _gl_lines().add_verts(
+                    np.stack([points[:-1], points[1:]], axis=1).reshape(-1, 2),
+                    color)
+        else:
+            _gl_strips().add_strips(points[None], color)
+    else:
+        points = pos2screen_arr(points).tolist()
+        mark_dirty(pygame.draw.lines(state.surface, color, closed, points))
 
 def draw_dot(pos, color=Color.BLACK):
     dot_size = state.scale / 4
@@ -287,31 +1223,100 @@ def draw_dot(pos, color=Color.BLACK):
     draw_line(pos, pos + right, color)
 
 def draw_surf(pos_px, surface, rotate=0):
-    draw_batch()
-    if rotate != 0:
-        surface = pygame.transform.rotate(surface, rotate)
+    if _record_call(draw_surf, pos_px, surface, rotate=rotate):
+        return
+    sim_utils.frame_stats.surfaces += 1
     if state.gl:
-        gl = state.gl
-        old_prog = state.gl_curr_shader
-        # it's a pain to do anything in the new opengl so we will draw text
-        # with the old pipeline
-        gl.glUseProgram(0)
-        data = pygame.image.tostring(surface, "RGBA", True)
-        pos = (pos_px[0], pos_px[1] + surface.get_height())
-        pos = Vec2(screen2pos(pos)) / state.scale
-        was_blend_enabled = gl.glIsEnabled(gl.GL_BLEND)
-        gl.glEnable(gl.GL_BLEND)
-        gl.glRasterPos3d(pos[0], pos[1], 0);
-        gl.glDrawPixels(surface.get_width(), surface.get_height(),
-                gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, data)
-        if old_prog != 0:
-            gl.glUseProgram(old_prog)
-        if not was_blend_enabled:
-            gl.glDisable(gl.GL_BLEND)
+        # the surface is drawn as a textured quad, rotated by the gpu, so it
+        # is only uploaded again when it's pixels change
+        texture = state.gl_surf_textures.get(surface)
+        width, height = surface.get_size()
+        pos = _QUAD * (width, height)
+        if rotate != 0:
+            pos = _rotate_px(pos, width, height, rotate)
+        _queue_use(state.gl_surf_batch, state.gl_text_shader, texture=texture,
+                blend=True)
+        state.gl_surf_batch.add_verts(_px_arr(pos, pos_px), Color.WHITE,
+                tex_uv=_QUAD)
     else:
-        state.surface.blit(surface, pos_px)
+        if rotate != 0:
+            surface = pygame.transform.rotate(surface, rotate)
+        mark_dirty(state.surface.blit(surface, pos_px))
+
+# the corners of the two triangles of a quad, in [0, 1]x[0, 1], y going down
+_QUAD = np.array([[0, 0], [1, 0], [1, 1], [1, 1], [0, 1], [0, 0]],
+        dtype=np.float32)
+
+# rotates points given in pixels inside a width x height box, the way
+# pygame.transform.rotate does, counterclockwise on screen, followed by moving
+# the bounding box of the rotated box back to (0, 0)
+def _rotate_px(pos, width, height, rotate):
+    a = np.radians(rotate)
+    c, s = np.cos(a), np.sin(a)
+    corners = np.array([[0, 0], [width, 0], [0, height], [width, height]],
+            dtype=np.float32)
+    rot = np.array([[c, -s], [s, c]], dtype=np.float32)
+    return pos @ rot - (corners @ rot).min(axis=0)
+
+# moves pixels relative to pos_px on the screen, like blit, we start at a
+# whole pixel
+def _px_arr(pos, pos_px):
+    return pos + (int(pos_px[0]), int(pos_px[1]))
+
+# the number of glyphs a text batch can hold before being drawn
+SIM_TEXT_GLYPHS_PER_BATCH = 8192
+
+def _text_batch(font_obj):
+    if font_obj not in state.gl_text_batches:
+        gl = state.gl
+        atlas = sim_utils.GlyphAtlas(font_obj, gl=gl)
+        batch = sim_utils.TriangleBatch(state.gl_text_shader, gl=gl,
+                vert_format=SIM_VERT_FORMAT_2D_UV,
+                capacity=SIM_TEXT_GLYPHS_PER_BATCH * 2)
+        batch.flush_fn = draw_batch
+        state.gl_text_batches[font_obj] = (atlas, batch)
+    return state.gl_text_batches[font_obj]
+
+# draws `text` as if it was rendered by font_obj on a surface and that surface
+# was drawn with draw_surf(pos_px, surface, rotate)
+# - pos_px is the top-left corner of the bounding box of the text, as given
+# by font_obj.get_rect(text)
+# - in opengl the text is drawn from a glyph atlas, with the rest of the
+# batched geometry
+def draw_text(pos_px, text, font_obj=None, color=Color.BLACK, rotate=0):
+    if not font_obj:
+        font_obj = state.font
+    if not state.gl:
+        # most labels don't change from one frame to the next, so we keep the
+        # rendered (and rotated) surfaces around
+        key = (text, font_obj.font_name, font_obj.font_size, tuple(color),
+                rotate)
+        text_surf = state.text_cache.get(key)
+        if text_surf is None:
+            text_surf, rect = font_obj.font.render(text, color)
+            if rotate != 0:
+                text_surf = pygame.transform.rotate(text_surf, rotate)
+            state.text_cache.put(key, text_surf)
+        draw_surf(pos_px, text_surf)
+        return
+    if _record_call(draw_text, pos_px, text, font_obj, color, rotate):
+        return
+    if not text:
+        return
+    atlas, batch = _text_batch(font_obj)
+    rect = font_obj.get_rect(text)
+    pos, uv = atlas.layout(text)
+    # relative to the top-left corner of the bounding box
+    pos[:, 0] -= rect.x
+    pos[:, 1] += rect.y
+    if rotate != 0:
+        pos = _rotate_px(pos, rect.width, rect.height, rotate)
+    _queue_use(batch, state.gl_text_shader, texture=atlas.texture, blend=True)
+    batch.add_verts(_px_arr(pos, pos_px), color, tex_uv=uv)
 
 def draw_aabb(posA, posB, color=Color.BLACK, filled=False):
+    if _outside_box(posA, posB):
+        return
     if state.gl:
         minx = min(posA[0], posB[0])
         miny = min(posA[1], posB[1])
@@ -329,6 +1334,10 @@ def draw_aabb(posA, posB, color=Color.BLACK, filled=False):
         else:
             draw_triangle(AA, AB, BB, color, True)
             draw_triangle(BB, BA, AA, color, True)
+    elif state.camera.rotation != 0:
+        # the box is not aligned with the screen anymore
+        draw_quad(posA, (posB[0], posA[1]), posB, (posA[0], posB[1]), color,
+                filled)
     else:
         posA = pos2screen(posA)
         posB = pos2screen(posB)
@@ -339,42 +1348,33 @@ def draw_aabb(posA, posB, color=Color.BLACK, filled=False):
         border = 1
         if filled:
             border = 0
-        pygame.draw.rect(state.surface, color,
-                pygame.Rect(minx, miny, maxx - minx, maxy - miny), border)
+        mark_dirty(pygame.draw.rect(state.surface, color,
+                pygame.Rect(minx, miny, maxx - minx, maxy - miny), border))
 
 def draw_circle(pos, rad, color=Color.BLACK, filled=False):
+    r = abs(rad)
+    if _outside_box((pos[0] - r, pos[1] - r), (pos[0] + r, pos[1] + r)):
+        return
     if state.gl:
-        pos = glm.vec2(pos)
-        n = 30
-        a_inc = 2 * np.pi / n
-        if filled:
-            for i in range(n):
-                a = a_inc * i
-                v1 = pos + glm.vec2(np.cos(a), np.sin(a)) * rad
-                v2 = pos + glm.vec2(np.cos(a + a_inc), np.sin(a + a_inc)) * rad
-                draw_triangle(pos, v1, v2, color, True)
-        else:
-            for i in range(n):
-                a = a_inc * i
-                v1 = pos + glm.vec2(np.cos(a), np.sin(a)) * rad
-                v2 = pos + glm.vec2(np.cos(a + a_inc), np.sin(a + a_inc)) * rad
-                draw_line(v1, v2, color)
+        _draw_circles([pos[0], pos[1]], rad, color, filled, cull=False)
     else:
         pos = pos2screen(pos)
         rad = dist2px(rad)
         border = 1
         if filled:
             border = 0
-        pygame.draw.circle(state.surface, color, pos, rad, border)
+        mark_dirty(pygame.draw.circle(state.surface, color, pos, rad, border))
 
 def draw_triangle(posA, posB, posC, color=Color.BLACK, filled=False):
+    if _outside_view((posA[0], posB[0], posC[0]), (posA[1], posB[1], posC[1])):
+        return
     if state.gl:
         if filled:
-            posA = Vec4(posA[0], posA[1], 0, state.scale) / state.scale
-            posB = Vec4(posB[0], posB[1], 0, state.scale) / state.scale
-            posC = Vec4(posC[0], posC[1], 0, state.scale) / state.scale
-            state.gl_triangle_batch.add_triangle(
-                    Vert(posA, color), Vert(posB, color), Vert(posC, color))
+            _gl_triangles().add((
+                (posA[0], posA[1]),
+                (posB[0], posB[1]),
+                (posC[0], posC[1])
+            ), color)
         else:
             draw_line(posA, posB, color)
             draw_line(posB, posC, color)
@@ -386,9 +1386,13 @@ def draw_triangle(posA, posB, posC, color=Color.BLACK, filled=False):
         border = 1
         if filled:
             border = 0
-        pygame.draw.polygon(state.surface, color, [posA, posB, posC], border)
+        mark_dirty(pygame.draw.polygon(state.surface, color,
+                [posA, posB, posC], border))
 
 def draw_quad(posA, posB, posC, posD, color=Color.BLACK, filled=False):
+    if _outside_view((posA[0], posB[0], posC[0], posD[0]),
+            (posA[1], posB[1], posC[1], posD[1])):
+        return
     if state.gl:
         if not filled:
             draw_line(posA, posB, color)
@@ -406,8 +1410,173 @@ def draw_quad(posA, posB, posC, posD, color=Color.BLACK, filled=False):
         border = 1
         if filled:
             border = 0
-        pygame.draw.polygon(state.surface, color,
-                [posA, posB, posC, posD], border)
+        mark_dirty(pygame.draw.polygon(state.surface, color,
+                [posA, posB, posC, posD], border))
+
+# Bulk drawing primitives:
+# ==============================================================================
+
+# Those functions draw many shapes in a single call, they take numpy arrays (or
+# anything that converts to one) and a color that is either shared by all the
+# shapes or an array with one color per shape
+
+# returns (color, per_item), where color is a (4,) or a (N, 4) array
+def _bulk_color(color, cnt):
+    color = np.asarray(color, dtype=np.float32)
+    if color.ndim == 1:
+        return color, False
+    if color.shape != (cnt, 4):
+        raise Exception("Expected one color for each shape")
+    return color, True
+
+# returns the colors as a list of tuples that pygame can use
+def _bulk_color_px(color, per_item, cnt):
+    if per_item:
+        return [tuple(c) for c in color.astype(int).tolist()]
+    return [tuple(color.astype(int).tolist())] * cnt
+
+# the number of segments used for a circle is chosen from this table, depending
+# on it's size on screen, such that the distance from the real circle to the
+# drawn one is at most SIM_CIRCLE_MAX_ERR_PX pixels
+SIM_CIRCLE_LODS = np.array([8, 12, 16, 24, 32, 48, 64, 96, 128])
+SIM_CIRCLE_MAX_ERR_PX = 0.25
+
+def _circle_segments(radius):
+    rad_px = np.abs(radius) * state.px_per_unit
+    err = np.minimum(SIM_CIRCLE_MAX_ERR_PX / np.maximum(rad_px, 1e-6), 1)
+    # the maximum error for n segments is rad_px * (1 - cos(pi / n))
+    needed = np.pi / np.arccos(1 - err)
+    lod = np.searchsorted(SIM_CIRCLE_LODS, needed)
+    return SIM_CIRCLE_LODS[np.minimum(lod, len(SIM_CIRCLE_LODS) - 1)]
+
+# draws circles that share the same number of segments `n`
+def _draw_circles_gl(centers, radius, color, per_item, filled, n):
+    unit = sim_utils.unit_circle(n)
+    # (N, n + 1, 2) the points on the circle, the last one is the first
+    ring = centers[:, None, :] + unit[None, :, :] * radius[:, None, None]
+    # the circles were already culled, their pieces don't need to be
+    if filled:
+        tris = np.empty((len(centers), n, 3, 2), dtype=np.float32)
+        tris[:, :, 0] = centers[:, None, :]
+        tris[:, :, 1] = ring[:, :-1]
+        tris[:, :, 2] = ring[:, 1:]
+        if per_item:
+            color = np.repeat(color, n * 3, axis=0)
+        _gl_triangles().add_verts(_pos2gl_arr(tris), color)
+    elif state.recording:
+        # static meshes only keep lines and triangles
+        segs = np.empty((len(centers), n, 2, 2), dtype=np.float32)
+        segs[:, :, 0] = ring[:, :-1]
+        segs[:, :, 1] = ring[:, 1:]
+        if per_item:
+            color = np.repeat(color, n * 2, axis=0)
+        _gl_lines().add_verts(_pos2gl_arr(segs), color)
+    else:
+        # each outline is a closed strip of n + 1 points
+        if per_item:
+            color = np.repeat(color, n + 1, axis=0)
+        _gl_strips().add_strips(ring, color)
+
+# segments - array of shape (N, 2, 2), the two ends of each line
+def draw_lines(segments, color=Color.BLACK):
+    segments = np.asarray(segments, dtype=np.float32).reshape(-1, 2, 2)
+    cnt = len(segments)
+    if cnt == 0:
+        return
+    color, per_item = _bulk_color(color, cnt)
+    keep = _view_mask(segments.min(axis=1), segments.max(axis=1))
+    if keep is not None:
+        segments = segments[keep]
+        color = color[keep] if per_item else color
+        cnt = len(segments)
+        if cnt == 0:
+            return
+    if state.gl:
+        if per_item:
+            color = np.repeat(color, 2, axis=0)
+        _gl_lines().add_verts(_pos2gl_arr(segments), color)
+    else:
+        segments = pos2screen_arr(segments).tolist()
+        colors = _bulk_color_px(color, per_item, cnt)
+        surface = state.surface
+        rects = [pygame.draw.line(surface, c, posA, posB)
+                for (posA, posB), c in zip(segments, colors)]
+        mark_dirty(rects[0].unionall(rects[1:]))
+
+# triangles - array of shape (N, 3, 2), the three corners of each triangle
+def draw_triangles(triangles, color=Color.BLACK, filled=False):
+    triangles = np.asarray(triangles, dtype=np.float32).reshape(-1, 3, 2)
+    cnt = len(triangles)
+    if cnt == 0:
+        return
+    color, per_item = _bulk_color(color, cnt)
+    keep = _view_mask(triangles.min(axis=1), triangles.max(axis=1))
+    if keep is not None:
+        triangles = triangles[keep]
+        color = color[keep] if per_item else color
+        cnt = len(triangles)
+        if cnt == 0:
+            return
+    if state.gl:
+        # one color per vertex when filled and one per edge otherwise
+        if per_item:
+            color = np.repeat(color, 3, axis=0)
+        if filled:
+            _gl_triangles().add_verts(_pos2gl_arr(triangles), color)
+        else:
+            draw_lines(triangles[:, [0, 1, 1, 2, 2, 0]], color)
+    else:
+        triangles = pos2screen_arr(triangles).tolist()
+        colors = _bulk_color_px(color, per_item, cnt)
+        surface = state.surface
+        border = 0 if filled else 1
+        rects = [pygame.draw.polygon(surface, c, tri, border)
+                for tri, c in zip(triangles, colors)]
+        mark_dirty(rects[0].unionall(rects[1:]))
+
+# centers - array of shape (N, 2)
+# radius - a single radius for all circles or an array of shape (N,)
+def draw_circles(centers, radius, color=Color.BLACK, filled=False):
+    _draw_circles(centers, radius, color, filled, cull=True)
+
+# draw_circle already checked its one circle, so it skips the mask
+def _draw_circles(centers, radius, color, filled, cull):
+    centers = np.asarray(centers, dtype=np.float32).reshape(-1, 2)
+    cnt = len(centers)
+    if cnt == 0:
+        return
+    radius = np.broadcast_to(np.asarray(radius, dtype=np.float32), (cnt,))
+    color, per_item = _bulk_color(color, cnt)
+    keep = None
+    if cull:
+        r = np.abs(radius)[:, None]
+        keep = _view_mask(centers - r, centers + r)
+    if keep is not None:
+        centers = centers[keep]
+        radius = radius[keep]
+        color = color[keep] if per_item else color
+        cnt = len(centers)
+        if cnt == 0:
+            return
+    if state.gl:
+        segments = _circle_segments(radius)
+        lods = np.unique(segments)
+        if len(lods) == 1:
+            _draw_circles_gl(centers, radius, color, per_item, filled, lods[0])
+            return
+        for n in lods:
+            sel = segments == n
+            _draw_circles_gl(centers[sel], radius[sel],
+                    color[sel] if per_item else color, per_item, filled, n)
+    else:
+        centers = pos2screen_arr(centers).tolist()
+        radius = (radius * state.px_per_unit).astype(int).tolist()
+        colors = _bulk_color_px(color, per_item, cnt)
+        surface = state.surface
+        border = 0 if filled else 1
+        rects = [pygame.draw.circle(surface, c, pos, rad, border)
+                for pos, rad, c in zip(centers, radius, colors)]
+        mark_dirty(rects[0].unionall(rects[1:]))
 
 # Interactive objects:
 # ==============================================================================
@@ -449,3 +1618,458 @@ def _interactive_on_draw():
 
 def interactive_add(interactive_obj):
     state.interactive.elements.append(interactive_obj)
+
+# Instanced primitives:
+# ==============================================================================
+
+# Those functions draw many copies of the same shape, in opengl the shape is
+# uploaded once and each copy only costs it's center, size, rotation and color
+
+INSTANCE_CIRCLE = 0     # a circle of radius 1, scaled by size
+INSTANCE_BOX = 1        # the square [-1, 1]x[-1, 1], scaled by size
+
+_BOX_CORNERS = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]], dtype=np.float32)
+
+def _inst_batch(kind, filled, segments):
+    key = (kind, filled, segments)
+    if key in state.gl_inst_batches:
+        return state.gl_inst_batches[key]
+    gl = state.gl
+    if kind == INSTANCE_CIRCLE:
+        ring = sim_utils.unit_circle(segments)
+        if filled:
+            mesh = np.zeros((segments, 3, 2), dtype=np.float32)
+            mesh[:, 1] = ring[:-1]
+            mesh[:, 2] = ring[1:]
+        else:
+            mesh = np.stack([ring[:-1], ring[1:]], axis=1)
+    elif kind == INSTANCE_BOX:
+        if filled:
+            mesh = _BOX_CORNERS[[0, 1, 2, 2, 3, 0]]
+        else:
+            mesh = _BOX_CORNERS[[0, 1, 1, 2, 2, 3, 3, 0]]
+    else:
+        raise Exception("Unknown instance kind")
+    primitive = gl.GL_TRIANGLES if filled else gl.GL_LINES
+    batch = sim_utils.InstanceBatch(state.gl_inst_shader, mesh, primitive,
+            gl=gl)
+    batch.flush_fn = draw_batch
+    state.gl_inst_batches[key] = batch
+    return batch
+
+# scales, rotates and moves the points `local` of shape (M, 2) for each of the
+# instances, returns an array of shape (N, M, 2)
+def _inst_points(local, centers, sizes, rotations):
+    c = np.cos(rotations)[:, None]
+    s = np.sin(rotations)[:, None]
+    pts = local[None, :, :] * sizes[:, None, :]
+    x = pts[..., 0] * c - pts[..., 1] * s
+    y = pts[..., 0] * s + pts[..., 1] * c
+    return np.stack([x, y], axis=-1) + centers[:, None, :]
+
+# kind      - one of the INSTANCE_* shapes
+# centers   - array of shape (N, 2)
+# sizes     - the scale of the instances, a single value, an array of shape
+#           (N,), an (x, y) pair or an array of shape (N, 2) for different x
+#           and y scales
+#           * for circles this is the radius, for boxes the half of each side
+# rotations - a single value or an array of shape (N,), in radians
+def draw_instanced(kind, centers, sizes=1, rotations=0, color=Color.BLACK,
+        filled=False):
+    if _record_call(draw_instanced, kind, centers, sizes, rotations, color,
+            filled):
+        return
+    centers = np.asarray(centers, dtype=np.float32).reshape(-1, 2)
+    cnt = len(centers)
+    if cnt == 0:
+        return
+    sizes = np.asarray(sizes, dtype=np.float32)
+    if sizes.ndim == 2 or (sizes.shape == (2,) and cnt != 2):
+        sizes = np.broadcast_to(sizes, (cnt, 2))
+    else:
+        sizes = np.broadcast_to(sizes, (cnt,))
+        sizes = np.stack([sizes, sizes], axis=-1)
+    rotations = np.broadcast_to(
+            np.asarray(rotations, dtype=np.float32), (cnt,))
+    color, per_item = _bulk_color(color, cnt)
+    # the corners of the box reach sqrt(2) times the size
+    r = np.abs(sizes).max(axis=1, keepdims=True) * \
+            (1 if kind == INSTANCE_CIRCLE else np.sqrt(2))
+    keep = _view_mask(centers - r, centers + r)
+    if keep is not None:
+        centers = centers[keep]
+        sizes = sizes[keep]
+        rotations = rotations[keep]
+        color = color[keep] if per_item else color
+        cnt = len(centers)
+        if cnt == 0:
+            return
+    if state.gl:
+        if kind == INSTANCE_CIRCLE:
+            segments = _circle_segments(np.max(np.abs(sizes), axis=-1))
+        else:
+            segments = np.zeros(cnt, dtype=int)
+        for n in np.unique(segments):
+            sel = segments == n
+            batch = _inst_batch(kind, filled, n)
+            _queue_use(batch, state.gl_inst_shader)
+            batch.add_instances(centers[sel],
+                    sizes[sel], rotations[sel],
+                    color[sel] if per_item else color)
+    elif kind == INSTANCE_CIRCLE and np.all(sizes[:, 0] == sizes[:, 1]):
+        draw_circles(centers, sizes[:, 0], color, filled)
+    else:
+        if kind == INSTANCE_CIRCLE:
+            local = sim_utils.unit_circle(SIM_CIRCLE_LODS[-1])[:-1]
+        else:
+            local = _BOX_CORNERS
+        pts = _inst_points(local, centers, sizes, rotations)
+        polys = pos2screen_arr(pts).tolist()
+        colors = _bulk_color_px(color, per_item, cnt)
+        surface = state.surface
+        border = 0 if filled else 1
+        rects = [pygame.draw.polygon(surface, c, poly, border)
+                for poly, c in zip(polys, colors)]
+        mark_dirty(rects[0].unionall(rects[1:]))
+
+# Draw queue:
+# ==============================================================================
+
+# With opengl nothing is drawn right away, the geometry waits in the batches
+# and the draw queue keeps the order in which it was added, as runs of geometry
+# that share a batch, a shader and a layer. When the queue is drawn the runs
+# are sorted by layer and each run joins the last run before it with the same
+# state, if it doesn't overlap any of the runs in between, so the painter's
+# order is kept only where it can be seen.
+
+class _Run:
+    __slots__ = ('batch', 'shader', 'texture', 'blend', 'layer', 'start',
+            'end', 'fn', 'barrier', 'bbox', 'ranges')
+
+    def __init__(self, batch, shader, texture, blend, layer, start, fn=None,
+            barrier=None, bbox=None):
+        self.batch = batch
+        self.shader = shader
+        self.texture = texture
+        self.blend = blend
+        self.layer = layer
+        self.start = start
+        self.end = start
+        self.fn = fn
+        self.barrier = barrier
+        self.bbox = bbox
+        self.ranges = None
+
+# draws with a higher layer end up over the ones with a lower layer, whatever
+# the order they were made in, returns the old layer, only used with opengl
+def set_layer(layer):
+    old_layer = state.layer
+    _queue_close()
+    state.layer = layer
+    return old_layer
+
+# must be called before adding geometry to a batch, to put it in a run, the
+# open run is closed on each shader or layer change, so a run with the same
+# batch and texture is still good
+def _queue_use(batch, shader, texture=0, blend=False):
+    run = state.gl_run
+    if run is not None and run.batch is batch and run.texture == texture:
+        return
+    # retained batches belong to the static mesh that is being recorded
+    if batch.retained:
+        return
+    _queue_close(run)
+    state.gl_run = _Run(batch, shader, texture, blend, state.layer,
+            batch.count)
+
+def _queue_close(run=None):
+    run = run or state.gl_run
+    if not run:
+        return
+    state.gl_run = None
+    run.end = run.batch.count
+    if run.end > run.start:
+        state.gl_queue.append(run)
+
+# fn is called when the queue reaches it:
+# - bbox is the part of the screen fn draws on, None if it is not known
+# - barrier is a shader that can't have its runs moved across fn, for uniform
+# changes
+def _queue_call(fn, bbox=None, barrier=None):
+    _queue_close()
+    state.gl_queue.append(_Run(None, None, 0, False, state.layer, 0, fn=fn,
+            barrier=barrier, bbox=bbox))
+
+# the line, triangle and strip batches of the current shader, taken trough the
+# draw queue
+def _gl_lines():
+    batch = state.gl_line_batch
+    run = state.gl_run
+    if run is None or run.batch is not batch:
+        _queue_use(batch, state.gl_curr_shader)
+    return batch
+
+def _gl_triangles():
+    batch = state.gl_triangle_batch
+    run = state.gl_run
+    if run is None or run.batch is not batch:
+        _queue_use(batch, state.gl_curr_shader)
+    return batch
+
+def _gl_strips():
+    batch = state.gl_strip_batch
+    run = state.gl_run
+    if run is None or run.batch is not batch:
+        _queue_use(batch, state.gl_curr_shader)
+    return batch
+
+# the shaders for which we know where the vertices end up on the screen
+def _bounded_shader(shader):
+    return shader in (state.gl_def_shader, state.gl_inst_shader,
+            state.gl_text_shader)
+
+# bounding boxes are (x0, y0, x1, y1) tuples of floats
+def _union_bounds(a, b):
+    if a is None:
+        return b
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]),
+            max(a[3], b[3]))
+
+# the bounding boxes on the screen of the boxes from lo to hi, arrays of shape
+# (N, 2) in the coord space, or in pixels if not to_screen
+def _screen_bounds(lo, hi, to_screen=True):
+    if to_screen:
+        corners = np.stack([lo, hi, np.stack([lo[:, 0], hi[:, 1]], axis=-1),
+                np.stack([hi[:, 0], lo[:, 1]], axis=-1)], axis=1)
+        corners = _transform_arr(state.view, corners)
+        lo, hi = corners.min(axis=1), corners.max(axis=1)
+    return [(x0, y0, x1, y1)
+            for (x0, y0), (x1, y1) in zip(lo.tolist(), hi.tolist())]
+
+# sets the bbox of the runs, with one bounds call for each batch
+def _set_run_bounds(runs):
+    batch_runs = {}
+    for run in runs:
+        if not run.fn:
+            batch_runs.setdefault(run.batch, []).append(run)
+    for batch, runs in batch_runs.items():
+        lo, hi = batch.bounds([run.start for run in runs],
+                [run.end for run in runs])
+        # text and surfaces are placed in pixels
+        to_screen = runs[0].shader != state.gl_text_shader
+        for run, bbox in zip(runs, _screen_bounds(lo, hi, to_screen)):
+            run.bbox = bbox if _bounded_shader(run.shader) else None
+
+def _runs_overlap(a, b):
+    if a.barrier is not None:
+        return a.barrier == b.shader
+    a, b = a.bbox, b.bbox
+    if a is None or b is None:
+        return True
+    # lines are drawn a pixel wide, so we leave a few pixels between runs
+    pad = 4
+    return a[0] - pad <= b[2] and b[0] - pad <= a[2] and \
+            a[1] - pad <= b[3] and b[1] - pad <= a[3]
+
+def _merge_runs(runs):
+    merged = []
+    for run in runs:
+        run.ranges = [(run.start, run.end - run.start)]
+        if run.fn:
+            merged.append(run)
+            continue
+        target = None
+        for other in reversed(merged):
+            if other.layer != run.layer:
+                break
+            if not other.fn and other.batch is run.batch and \
+                    other.shader == run.shader and \
+                    other.texture == run.texture:
+                target = other
+                break
+            if _runs_overlap(other, run):
+                break
+        if not target:
+            merged.append(run)
+            continue
+        first, count = target.ranges[-1]
+        if first + count == run.start:
+            target.ranges[-1] = (first, count + run.end - run.start)
+        else:
+            target.ranges.append((run.start, run.end - run.start))
+        if target.bbox is not None:
+            target.bbox = None if run.bbox is None else \
+                    _union_bounds(target.bbox, run.bbox)
+    return merged
+
+def _draw_runs(runs):
+    gl = state.gl
+    # each batch is sent to the gpu once, with all of its geometry
+    bases = {}
+    for run in runs:
+        if run.batch and run.batch not in bases:
+            bases[run.batch] = run.batch.upload() or 0
+    _set_run_bounds(runs)
+    runs = _merge_runs(sorted(runs, key=lambda run: run.layer))
+
+    blend_default = gl.glIsEnabled(gl.GL_BLEND)
+    program, blend, texture = None, blend_default, 0
+    for run in runs:
+        if run.fn:
+            run.fn()
+            # fn can change anything
+            program, blend, texture = None, None, None
+            continue
+        if run.shader != program:
+            gl.glUseProgram(run.shader)
+            program = run.shader
+        run_blend = run.blend or blend_default
+        if run_blend != blend:
+            if run_blend:
+                gl.glEnable(gl.GL_BLEND)
+            else:
+                gl.glDisable(gl.GL_BLEND)
+            blend = run_blend
+        if run.texture != texture:
+            gl.glBindTexture(gl.GL_TEXTURE_2D, run.texture)
+            texture = run.texture
+        batch = run.batch
+        if isinstance(batch, sim_utils.InstanceBatch):
+            for first, count in run.ranges:
+                batch.draw_range(first, count)
+        else:
+            batch.draw_ranges(run.shader,
+                    *batch.vert_ranges(bases[batch], run.ranges))
+
+    if blend != blend_default:
+        if blend_default:
+            gl.glEnable(gl.GL_BLEND)
+        else:
+            gl.glDisable(gl.GL_BLEND)
+    if texture != 0:
+        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+    gl.glUseProgram(state.gl_curr_shader)
+    for batch in bases:
+        batch.count = 0
+
+# Static meshes:
+# ==============================================================================
+
+# A StaticMesh remembers what was drawn while recording it and draws it again
+# with a single call, without recomputing the geometry every frame. In opengl
+# the lines and triangles are kept in their own buffers on the gpu, without
+# opengl everything is drawn on a cached surface.
+# - if draw_fn is given the mesh will record it on the first draw and after
+# each `invalidate`, otherwise use `record` to fill the mesh
+# - in opengl, surfaces(text) and instanced primitives are not part of the
+# buffers, they are remembered and drawn again on each draw
+#
+# Example:
+#   border = sim.StaticMesh(draw_border)
+#   def draw_fn():
+#       border.draw()
+class StaticMesh:
+    def __init__(self, draw_fn=None):
+        self.draw_fn = draw_fn
+        self.valid = False
+        self._line_batch = None
+        self._triangle_batch = None
+        self._calls = []
+        self._surface = None
+        self._surface_pos = (0, 0)
+        self._surface_view = None
+        self._bounds = None
+
+    def invalidate(self):
+        self.valid = False
+
+    # all the drawing done inside this context goes to the mesh instead of the
+    # screen
+    @contextlib.contextmanager
+    def record(self):
+        if state.recording:
+            raise Exception("Can't record two static meshes at the same time")
+        gl = state.gl
+        self._calls = []
+        if gl:
+            if not self._line_batch:
+                vert_format = state.gl_line_batch.vert_format
+                self._line_batch = sim_utils.LineBatch(state.gl_curr_shader,
+                        gl=gl, vert_format=vert_format, capacity=256,
+                        retained=True)
+                self._triangle_batch = sim_utils.TriangleBatch(
+                        state.gl_curr_shader, gl=gl, vert_format=vert_format,
+                        capacity=256, retained=True)
+            self._line_batch.clear()
+            self._triangle_batch.clear()
+            saved = (state.gl_line_batch, state.gl_triangle_batch)
+            state.gl_line_batch = self._line_batch
+            state.gl_triangle_batch = self._triangle_batch
+            # the mesh can be drawn later with another view
+            state.cull_bounds = None
+        else:
+            saved = state.surface
+            state.surface = pygame.Surface((state.width, state.height),
+                    SRCALPHA)
+            state.surface.fill((0, 0, 0, 0))
+        state.recording = self
+        try:
+            yield self
+        finally:
+            state.recording = None
+            if gl:
+                state.gl_line_batch, state.gl_triangle_batch = saved
+                state.cull_bounds = _view_bounds()
+                # in the coord space, the view can change before a draw
+                self._bounds = None
+                for batch in (self._line_batch, self._triangle_batch):
+                    if batch.count > 0:
+                        lo, hi = batch.bounds([0], [batch.count])
+                        if self._bounds:
+                            lo = np.minimum(lo, self._bounds[0])
+                            hi = np.maximum(hi, self._bounds[1])
+                        self._bounds = (lo, hi)
+            else:
+                # we only keep the part of the surface that was drawn on
+                rect = state.surface.get_bounding_rect()
+                self._surface = state.surface.subsurface(rect).copy()
+                self._surface_pos = rect.topleft
+                self._surface_view = state.view
+                state.surface = saved
+        self.valid = True
+
+    def draw(self):
+        # without opengl the mesh is a picture of the screen, it must be taken
+        # again after the view changes
+        if not state.gl and self._surface_view != state.view:
+            self.valid = False
+        if not self.valid:
+            if not self.draw_fn:
+                return
+            with self.record():
+                self.draw_fn()
+        if state.gl:
+            shader = state.gl_curr_shader
+            def draw_mesh():
+                state.gl.glUseProgram(shader)
+                for batch in (self._line_batch, self._triangle_batch):
+                    batch.bind_shader(shader)
+                    batch.draw()
+            if self._bounds and in_view(self._bounds[0][0],
+                    self._bounds[1][0]):
+                bbox = None
+                if _bounded_shader(shader):
+                    bbox = _screen_bounds(*self._bounds)[0]
+                _queue_call(draw_mesh, bbox=bbox)
+            for fn, args, kwargs in self._calls:
+                fn(*args, **kwargs)
+        else:
+            mark_dirty(state.surface.blit(self._surface, self._surface_pos))
+
+# returns True if the call was saved inside the static mesh that is being
+# recorded, for the calls that can't be saved in the mesh buffers
+def _record_call(fn, *args, **kwargs):
+    if state.gl and state.recording:
+        state.recording._calls.append((fn, args, kwargs))
+        return True
+    return False
@@ -2,14 +2,90 @@ import glm
 import pygame
 import numpy as np
 import ctypes
+import bisect
+import collections
+import contextlib
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+import weakref
+import zlib
 
 SIM_GEOMETRY_PER_BATCH = 65536
+# the size in bytes of the vertex buffer of a batch (at least one full batch),
+# each flush writes after the last one and the buffer is only replaced when it
+# is full
+SIM_STREAM_BUFFER_SIZE = 4 * 1024 * 1024
 
-# sizeof(float) * (color + pos + normal + texcoords)
-SIM_VERT_SIZE = 4 * (4 + 4 + 3 + 2)
+# number of floats in a vertex: pos + color + normal + texcoords
+# * this is the size of a vertex in SIM_VERT_FORMAT_FULL
+SIM_VERT_FLOATS = 4 + 4 + 3 + 2
+SIM_VERT_SIZE = 4 * SIM_VERT_FLOATS
 SIM_TRIANGLE_SIZE = SIM_VERT_SIZE * 3
 SIM_LINE_SIZE = SIM_VERT_SIZE * 2
 
+SIM_INSTANCES_PER_BATCH = 65536
+
+# the profiler statistics are taken over this many frames
+SIM_PROFILE_FRAMES = 120
+# the number of frames that can wait for their gpu timer at the same time,
+# frames beyond that are not timed
+SIM_GPU_TIMER_QUERIES = 4
+# the version of the files written by EventRecorder
+SIM_EVENTS_VERSION = 1
+
+# number of floats in an instance: center + scale + rotation + color
+SIM_INSTANCE_FLOATS = 2 + 2 + 1 + 4
+SIM_INSTANCE_SIZE = 4 * SIM_INSTANCE_FLOATS
+
+# FrameStats counts the work given to opengl, the batches and textures of this
+# module add to `frame_stats`, the renderer resets it at the start of each frame
+# - draw_calls are the glDraw* calls, a glMultiDrawArrays is one call
+# - triangles and lines are the primitives drawn, instances included
+# - upload_bytes are the vertex, instance and texture bytes sent to the gpu
+# - gpu_time is set by the renderer from a GpuTimer, in seconds
+class FrameStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.draw_calls = 0
+        self.vertices = 0
+        self.triangles = 0
+        self.lines = 0
+        self.instances = 0
+        self.upload_bytes = 0
+        self.texture_uploads = 0
+        self.surfaces = 0
+        self.gpu_time = None
+
+    def copy(self):
+        stats = FrameStats()
+        stats.__dict__.update(self.__dict__)
+        return stats
+
+    # one draw call of `primitive` with the vertex ranges of `counts`, each of
+    # them drawn `instances` times
+    def add_draw(self, gl, primitive, counts, instances=1):
+        verts = sum(counts)
+        self.draw_calls += 1
+        self.vertices += verts * instances
+        if primitive == gl.GL_TRIANGLES:
+            self.triangles += verts // 3 * instances
+        elif primitive == gl.GL_LINES:
+            self.lines += verts // 2 * instances
+        elif primitive == gl.GL_LINE_STRIP:
+            self.lines += (verts - len(counts)) * instances
+
+    def __repr__(self):
+        return 'FrameStats(%s)' % ', '.join('%s=%s' % item
+                for item in self.__dict__.items())
+
+frame_stats = FrameStats()
+
 class Color:
     BLACK = glm.vec4(  0,   0,   0, 255)
     RED =   glm.vec4(255,   0,   0, 255)
@@ -20,126 +96,612 @@ class Color:
 class Vert:
     def __init__(self, p, c=Color.BLACK, n=glm.vec3(), t=glm.vec2()):
         self.p = glm.vec4(p)
-        self.c = glm.vec4(c) / 256
+        self.c = glm.vec4(c) / 255
         self.n = glm.vec3(n)
         self.t = glm.vec2(t)
 
+# colors are given in the [0, 255] range, like the ones in Color, those are the
+# converted colors of each vertex format, see VertFormat.pack_color
+SIM_MAX_PACKED_COLORS = 4096
+
+# A VertFormat describes the layout of a vertex inside the batch buffers
+# - attribs is a list of (name, count, numpy type) for each attribute of the
+# vertex, the name is the name of the input in the vertex shader
+# - float32 attributes are read as they are, uint8 attributes are normalized
+# to [0, 1] by opengl
+# - position and color are always present, the other attributes are set to 0
+# by the batches
+class VertFormat:
+    def __init__(self, name, attribs):
+        self.name = name
+        self.attribs = attribs
+        self.dtype = np.dtype([(a_name, a_type, (cnt,))
+                for a_name, cnt, a_type in attribs])
+        self.size = self.dtype.itemsize
+        self.pos_cnt = self.dtype['position'].shape[0]
+        self.packed = self.dtype['color'].base == np.uint8
+        self.extra = [a_name for a_name, cnt, a_type in attribs
+                if a_name not in ('position', 'color')]
+        self._colors = {}
+
+    # returns (name, count, gl type, normalized, offset) for each attribute
+    def gl_attribs(self, gl):
+        ret = []
+        for a_name, cnt, a_type in self.attribs:
+            offset = self.dtype.fields[a_name][1]
+            if a_type == np.uint8:
+                ret.append((a_name, cnt, gl.GL_UNSIGNED_BYTE, True, offset))
+            else:
+                ret.append((a_name, cnt, gl.GL_FLOAT, False, offset))
+        return ret
+
+    # converts an array of colors to this format
+    def convert_colors(self, color):
+        color = np.asarray(color, dtype=np.float32)
+        if self.packed:
+            return np.clip(color, 0, 255).astype(np.uint8)
+        return color / 255
+
+    # same as above but for a single color, the result is computed once for
+    # each color
+    def pack_color(self, color):
+        key = (color[0], color[1], color[2], color[3])
+        packed = self._colors.get(key)
+        if packed is None:
+            if len(self._colors) >= SIM_MAX_PACKED_COLORS:
+                self._colors.clear()
+            packed = self.convert_colors(key)
+            self._colors[key] = packed
+        return packed
+
+    # writes the vertices with positions `pos`, an array of shape (N, 2), and
+    # colors `color`, converted with the functions above, starting at `start`
+    # - the other attributes can be given by name in `extra`
+    def write(self, data, start, pos, color, **extra):
+        rows = data[start:start + len(pos)]
+        if self.pos_cnt == 2:
+            rows['position'] = pos
+        else:
+            position = rows['position']
+            position[:, 0:2] = pos
+            position[:, 2] = 0
+            position[:, 3:] = 1
+        rows['color'] = color
+        for a_name in self.extra:
+            rows[a_name] = extra.get(a_name, 0)
+
+# the layout of the Vert class
+SIM_VERT_FORMAT_FULL = VertFormat('full', [
+    ('position', 4, np.float32),
+    ('color', 4, np.float32),
+    ('normal', 3, np.float32),
+    ('tex_uv', 2, np.float32),
+])
+
+# only a 2D position and a color, 12 bytes per vertex, used by the default
+# shader, the position is read by `in vec4 position` as (x, y, 0, 1)
+SIM_VERT_FORMAT_2D = VertFormat('2d', [
+    ('position', 2, np.float32),
+    ('color', 4, np.uint8),
+])
+
+# same as above, with texture coordinates, used for text
+SIM_VERT_FORMAT_2D_UV = VertFormat('2d_uv', [
+    ('position', 2, np.float32),
+    ('color', 4, np.uint8),
+    ('tex_uv', 2, np.float32),
+])
+
+# we pack the colors we know we will use from the start
+for _c in (Color.BLACK, Color.RED, Color.GREEN, Color.BLUE, Color.WHITE):
+    SIM_VERT_FORMAT_FULL.pack_color(_c)
+    SIM_VERT_FORMAT_2D.pack_color(_c)
+    SIM_VERT_FORMAT_2D_UV.pack_color(_c)
+
+# returns the points of the unit circle split in `segments` equal arcs, in an
+# array of shape (segments + 1, 2) where the last point is the first one again
+# * the tables are computed once and shared, don't modify them
+_unit_circles = {}
+def unit_circle(segments):
+    if segments not in _unit_circles:
+        a = np.arange(segments + 1) * (2 * np.pi / segments)
+        table = np.stack([np.cos(a), np.sin(a)], axis=-1).astype(np.float32)
+        table[-1] = table[0]
+        table.flags.writeable = False
+        _unit_circles[segments] = table
+    return _unit_circles[segments]
+
+# the attribute locations of each shader program, they can't change after the
+# program is linked so we ask for them only once
+_attrib_locations = {}
+
+# returns a dict of {attribute name: location} with the active attributes of
+# shader
+def attrib_locations(gl, shader):
+    locs = _attrib_locations.get(shader)
+    if locs is None:
+        locs = {}
+        for i in range(gl.glGetProgramiv(shader, gl.GL_ACTIVE_ATTRIBUTES)):
+            name = gl.glGetActiveAttrib(shader, i)[0].decode()
+            locs[name] = gl.glGetAttribLocation(shader, name)
+        _attrib_locations[shader] = locs
+    return locs
+
 # In TriangleBatch objects we will add triangles and draw them later on loop
 # update or on shader change
+#
+# vertices are written in a preallocated CPU side staging array, laid out as
+# described by `vert_format`, and the filled part of it is uploaded with a
+# single call when the batch is drawn
+#
+# a `retained` batch keeps it's geometry after being drawn, it is uploaded only
+# after it changes and grows instead of drawing itself when it gets full, use
+# `clear` to empty it
 class MeshBatch:
-    def __init__(self, shader, geometry_size, gl=None):
+    def __init__(self, shader, geometry_verts, primitive, gl=None,
+            vert_format=SIM_VERT_FORMAT_FULL, capacity=SIM_GEOMETRY_PER_BATCH,
+            retained=False):
         if not gl:
             raise Exception("Can't use mesh batch without opengl")
         self.gl = gl
+        self.primitive = primitive
+        self.geometry_verts = geometry_verts
+        self.vert_format = vert_format
+        self.capacity = capacity
+        self.retained = retained
+        self.dirty = False
+        self.data = np.zeros(capacity * geometry_verts,
+                dtype=vert_format.dtype)
 
         self.vbo = gl.glGenBuffers(1)
         self.count = 0
+        self.stream_size = max(self.data.nbytes, SIM_STREAM_BUFFER_SIZE)
+        self.stream_pos = 0
         gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vbo)
         gl.glBufferData(
             gl.GL_ARRAY_BUFFER,
-            SIM_GEOMETRY_PER_BATCH * geometry_size,
+            self.data.nbytes if retained else self.stream_size,
             None,
-            gl.GL_DYNAMIC_DRAW
+            gl.GL_STATIC_DRAW if retained else gl.GL_STREAM_DRAW
         )
+        # a vertex array object for each shader the batch was drawn with
+        self.vaos = {}
+        # called instead of `draw` when the batch is full, for when the
+        # geometry is drawn by someone else
+        self.flush_fn = None
         self.bind_shader(shader)
 
+    # the attribute setup is done once per shader, after that switching
+    # shaders only selects another vao
     def bind_shader(self, shader):
+        self.shader = shader
+        if shader in self.vaos:
+            return
         gl = self.gl
+        vao = gl.glGenVertexArrays(1)
+        gl.glBindVertexArray(vao)
         gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vbo)
-        self.shader = shader
-        position = gl.glGetAttribLocation(shader, 'position')
-        if position >= 0:
-            gl.glVertexAttribPointer(position, 4, gl.GL_FLOAT, False,
-                    SIM_VERT_SIZE, ctypes.c_void_p(0))
-            gl.glEnableVertexAttribArray(position)
-
-        color = gl.glGetAttribLocation(shader, 'color')
-        if color >= 0:
-            gl.glVertexAttribPointer(color, 4, gl.GL_FLOAT, False,
-                    SIM_VERT_SIZE, ctypes.c_void_p(16))
-            gl.glEnableVertexAttribArray(color)
-
-        normal = gl.glGetAttribLocation(shader, 'normal')
-        if normal >= 0:
-            gl.glVertexAttribPointer(normal, 3, gl.GL_FLOAT, False,
-                    SIM_VERT_SIZE, ctypes.c_void_p(32))
-            gl.glEnableVertexAttribArray(normal)
-
-        tex_uv = gl.glGetAttribLocation(shader, 'tex_uv')
-        if tex_uv >= 0:
-            gl.glVertexAttribPointer(tex_uv, 2, gl.GL_FLOAT, False,
-                    SIM_VERT_SIZE, ctypes.c_void_p(44))
-            gl.glEnableVertexAttribArray(tex_uv)
+        vert_format = self.vert_format
+        locs = attrib_locations(gl, shader)
+        for name, cnt, gl_type, normalized, offset in \
+                vert_format.gl_attribs(gl):
+            loc = locs.get(name, -1)
+            if loc >= 0:
+                gl.glVertexAttribPointer(loc, cnt, gl_type, normalized,
+                        vert_format.size, ctypes.c_void_p(offset))
+                gl.glEnableVertexAttribArray(loc)
+        gl.glBindVertexArray(0)
+        self.vaos[shader] = vao
 
-class TriangleBatch(MeshBatch):
-    def __init__(self, shader, **kwargs):
-        super().__init__(shader, SIM_TRIANGLE_SIZE, **kwargs)
+    # makes room for at least `geometries` more geometries
+    def _make_room(self, geometries=1):
+        if self.count + geometries <= self.capacity:
+            return
+        if not self.retained:
+            (self.flush_fn or self.draw)()
+            return
+        while self.count + geometries > self.capacity:
+            self.capacity *= 2
+        data = np.zeros(self.capacity * self.geometry_verts,
+                dtype=self.vert_format.dtype)
+        data[:len(self.data)] = self.data
+        self.data = data
 
-    def add_triangle(self, vE: Vert, vF: Vert, vG: Vert):
-        gl = self.gl
-        if self.count == SIM_GEOMETRY_PER_BATCH:
-            self.draw()
+    # returns the index of the first vertex of the next geometry
+    def _next_vert(self):
+        self._make_room()
+        idx = self.count * self.geometry_verts
+        self.count += 1
+        self.dirty = True
+        return idx
 
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vbo)
-        triangle = [
-            vE.p.x, vE.p.y, vE.p.z, vE.p.w, vE.c.r, vE.c.g, vE.c.b, vE.c.a,
-            vE.n.x, vE.n.y, vE.n.z, vE.t.x, vE.t.y,
-            vF.p.x, vF.p.y, vF.p.z, vF.p.w, vF.c.r, vF.c.g, vF.c.b, vF.c.a,
-            vF.n.x, vF.n.y, vF.n.z, vF.t.x, vF.t.y,
-            vG.p.x, vG.p.y, vG.p.z, vG.p.w, vG.c.r, vG.c.g, vG.c.b, vG.c.a,
-            vG.n.x, vG.n.y, vG.n.z, vG.t.x, vG.t.y
-        ]
+    def _set_vert(self, idx, v: Vert):
+        vert_format = self.vert_format
+        color = vert_format.pack_color(v.c * 255)
+        vert_format.write(self.data, idx, [(v.p.x, v.p.y)], color)
+        if vert_format.pos_cnt == 4:
+            self.data['position'][idx] = v.p
+        if 'normal' in vert_format.extra:
+            self.data['normal'][idx] = v.n
+        if 'tex_uv' in vert_format.extra:
+            self.data['tex_uv'][idx] = v.t
 
-        triangle = np.array(triangle, dtype=np.float32)
+    # adds one geometry
+    # - pos is a sequence of geometry_verts (x, y) pairs
+    # - color is the color of all the vertices, in the [0, 255] range
+    def add(self, pos, color):
+        idx = self._next_vert()
+        self.vert_format.write(self.data, idx, pos,
+                self.vert_format.pack_color(color))
 
-        gl.glBufferSubData(
-            gl.GL_ARRAY_BUFFER,
-            SIM_TRIANGLE_SIZE * self.count,
-            triangle.nbytes,
-            triangle)
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
-        self.count += 1
+    # adds many geometries at once
+    # - pos is an array of shape (N * geometry_verts, 2)
+    # - color is a single color or an array of shape (N * geometry_verts, 4),
+    # in the [0, 255] range
+    # - the other attributes of the format can be given by name in `extra`, as
+    # arrays with one element for each vertex
+    def add_verts(self, pos, color, **extra):
+        vert_format = self.vert_format
+        color = vert_format.convert_colors(color)
+        vert_cnt = len(pos)
+        done = 0
+        while done < vert_cnt:
+            self._make_room()
+            start = self.count * self.geometry_verts
+            cnt = min(vert_cnt - done, len(self.data) - start)
+            vert_format.write(self.data, start, pos[done:done + cnt],
+                    color if color.ndim == 1 else color[done:done + cnt],
+                    **{k: v[done:done + cnt] for k, v in extra.items()})
+            self.count += cnt // self.geometry_verts
+            self.dirty = True
+            done += cnt
+
+    def clear(self):
+        self.count = 0
+        self.dirty = True
 
     def draw(self):
         if self.count > 0:
-            gl = self.gl
-            self.bind_shader(self.shader)
-            gl.glDrawArrays(gl.GL_TRIANGLES, 0, 3 * self.count)
-            self.count = 0
+            base = self.upload()
+            self.draw_ranges(self.shader,
+                    *self.vert_ranges(base, [(0, self.count)]))
+            if not self.retained:
+                self.count = 0
+
+    # sends the geometry to the gpu and returns the index of the first vertex
+    # in the vertex buffer
+    def upload(self):
+        gl = self.gl
+        vert_cnt = self.count * self.geometry_verts
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vbo)
+        first = 0
+        if not self.retained:
+            first = self._stream(vert_cnt)
+        elif self.dirty:
+            gl.glBufferData(
+                gl.GL_ARRAY_BUFFER,
+                vert_cnt * self.vert_format.size,
+                self.data[:vert_cnt],
+                gl.GL_STATIC_DRAW)
+            frame_stats.upload_bytes += vert_cnt * self.vert_format.size
+        self.dirty = False
+        return first
+
+    # returns the (firsts, counts) vertex ranges that draw the geometries in
+    # `ranges`, (first, count) pairs of geometries, base is the index of the
+    # first vertex of the batch in the vertex buffer
+    def vert_ranges(self, base, ranges):
+        verts = self.geometry_verts
+        return ([base + first * verts for first, count in ranges],
+                [count * verts for first, count in ranges])
+
+    # draws the vertex ranges given by firsts and counts, the program must be
+    # in use
+    def draw_ranges(self, shader, firsts, counts):
+        gl = self.gl
+        self.bind_shader(shader)
+        gl.glBindVertexArray(self.vaos[shader])
+        if len(firsts) == 1:
+            gl.glDrawArrays(self.primitive, firsts[0], counts[0])
+        else:
+            gl.glMultiDrawArrays(self.primitive,
+                    np.asarray(firsts, dtype=np.int32),
+                    np.asarray(counts, dtype=np.int32), len(firsts))
+        gl.glBindVertexArray(0)
+        frame_stats.add_draw(gl, self.primitive, counts)
+
+    # returns the (min, max) corners of the positions of the geometries in
+    # each [start, end) range, as two arrays with a row for each range, the
+    # ranges must be sorted and follow one another
+    def bounds(self, starts, ends):
+        verts = self.geometry_verts
+        pos = self.data['position'][:ends[-1] * verts, :2]
+        starts = np.asarray(starts) * verts
+        return (np.minimum.reduceat(pos, starts),
+                np.maximum.reduceat(pos, starts))
+
+    # writes the first vert_cnt vertices in a part of the buffer that no
+    # previous draw reads from, so the write never waits for the gpu, returns
+    # the index of the first vertex written
+    def _stream(self, vert_cnt):
+        gl = self.gl
+        size = vert_cnt * self.vert_format.size
+        if self.stream_pos + size > self.stream_size:
+            # orphan the buffer, the draws still in flight keep the old storage
+            # and we get a new one
+            gl.glBufferData(gl.GL_ARRAY_BUFFER, self.stream_size, None,
+                    gl.GL_STREAM_DRAW)
+            self.stream_pos = 0
+        ptr = gl.glMapBufferRange(gl.GL_ARRAY_BUFFER, self.stream_pos, size,
+                gl.GL_MAP_WRITE_BIT | gl.GL_MAP_INVALIDATE_RANGE_BIT |
+                gl.GL_MAP_UNSYNCHRONIZED_BIT)
+        ctypes.memmove(ptr, self.data.ctypes.data, size)
+        gl.glUnmapBuffer(gl.GL_ARRAY_BUFFER)
+        frame_stats.upload_bytes += size
+        first = self.stream_pos // self.vert_format.size
+        self.stream_pos += size
+        return first
+
+class TriangleBatch(MeshBatch):
+    def __init__(self, shader, gl=None, **kwargs):
+        super().__init__(shader, 3, gl.GL_TRIANGLES, gl=gl, **kwargs)
+
+    def add_triangle(self, vE: Vert, vF: Vert, vG: Vert):
+        idx = self._next_vert()
+        self._set_vert(idx, vE)
+        self._set_vert(idx + 1, vF)
+        self._set_vert(idx + 2, vG)
 
 class LineBatch(MeshBatch):
-    def __init__(self, shader, **kwargs):
-        super().__init__(shader, SIM_LINE_SIZE, **kwargs)
+    def __init__(self, shader, gl=None, **kwargs):
+        super().__init__(shader, 2, gl.GL_LINES, gl=gl, **kwargs)
 
     def add_line(self, vE: Vert, vF: Vert):
-        gl = self.gl
-        if self.count == SIM_GEOMETRY_PER_BATCH:
-            self.draw()
+        idx = self._next_vert()
+        self._set_vert(idx, vE)
+        self._set_vert(idx + 1, vF)
+
+# A StripBatch holds connected lines, each strip of N points is N vertices
+# instead of the 2 * (N - 1) of a LineBatch. A geometry is a single vertex, the
+# batch remembers where each strip starts and all of them are drawn with one
+# glMultiDrawArrays call.
+class StripBatch(MeshBatch):
+    def __init__(self, shader, gl=None, **kwargs):
+        super().__init__(shader, 1, gl.GL_LINE_STRIP, gl=gl, **kwargs)
+        # the first vertex and the vertex count of each strip
+        self.strip_firsts = []
+        self.strip_counts = []
+
+    # adds strips of the same length
+    # - pos is an array of shape (N, L, 2), N strips of L points each
+    # - color is a single color or an array of shape (N * L, 4), in the
+    # [0, 255] range
+    # - strips longer than the batch are split in pieces that share their
+    # ends
+    def add_strips(self, pos, color):
+        vert_format = self.vert_format
+        color = vert_format.convert_colors(color)
+        strip_cnt, strip_len = pos.shape[:2]
+        if strip_len > self.capacity and not self.retained:
+            step = self.capacity - 1
+            for i in range(strip_cnt):
+                for k in range(0, strip_len - 1, step):
+                    end = min(k + self.capacity, strip_len)
+                    self.add_strips(pos[i:i + 1, k:end], color
+                            if color.ndim == 1 else
+                            color[i * strip_len + k:i * strip_len + end])
+            return
+        done = 0
+        while done < strip_cnt:
+            self._make_room(strip_len)
+            if self.count == 0:
+                # whoever drew the batch only reset the count
+                self.strip_firsts.clear()
+                self.strip_counts.clear()
+            start = self.count
+            cnt = min(strip_cnt - done, (self.capacity - start) // strip_len)
+            vert_cnt = cnt * strip_len
+            vert_first = done * strip_len
+            vert_format.write(self.data, start,
+                    pos[done:done + cnt].reshape(-1, 2), color
+                    if color.ndim == 1 else
+                    color[vert_first:vert_first + vert_cnt])
+            self.strip_firsts.extend(range(start, start + vert_cnt,
+                    strip_len))
+            self.strip_counts.extend([strip_len] * cnt)
+            self.count += vert_cnt
+            self.dirty = True
+            done += cnt
 
+    def clear(self):
+        super().clear()
+        self.strip_firsts.clear()
+        self.strip_counts.clear()
+
+    # the strips are never split between ranges, so each range is made of
+    # whole strips
+    def vert_ranges(self, base, ranges):
+        strip_firsts = self.strip_firsts
+        firsts = []
+        counts = []
+        for first, count in ranges:
+            i = bisect.bisect_left(strip_firsts, first)
+            j = bisect.bisect_left(strip_firsts, first + count)
+            firsts += [base + f for f in strip_firsts[i:j]]
+            counts += self.strip_counts[i:j]
+        return firsts, counts
+
+# In InstanceBatch objects we draw the same mesh many times with a single draw
+# call, each instance has it's own center, scale, rotation and color
+# - mesh is an array of shape (V, 2), the vertices of the mesh, drawn with
+# `primitive`
+# - the shader must take the mesh vertices in `position` and the per instance
+# data in `inst_center`, `inst_scale`, `inst_rotation` and `inst_color`
+# - the shader is only used while drawing, the caller must restore it's own
+# program afterwards
+class InstanceBatch:
+    def __init__(self, shader, mesh, primitive, gl=None):
+        if not gl:
+            raise Exception("Can't use instance batch without opengl")
+        self.gl = gl
+        self.shader = shader
+        self.primitive = primitive
+        mesh = np.ascontiguousarray(mesh, dtype=np.float32).reshape(-1, 2)
+        self.mesh_vert_cnt = len(mesh)
+        self.mesh_radius = float(np.linalg.norm(mesh, axis=1).max())
+        self.data = np.zeros((SIM_INSTANCES_PER_BATCH, SIM_INSTANCE_FLOATS),
+                dtype=np.float32)
+        self.count = 0
+        self.flush_fn = None
+        # the instances are sent again each frame
+        self.retained = False
+
+        self.mesh_vbo = gl.glGenBuffers(1)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.mesh_vbo)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, mesh.nbytes, mesh,
+                gl.GL_STATIC_DRAW)
+
+        self.vbo = gl.glGenBuffers(1)
         gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vbo)
-        line = [
-            vE.p.x, vE.p.y, vE.p.z, vE.p.w, vE.c.r, vE.c.g, vE.c.b, vE.c.a,
-            vE.n.x, vE.n.y, vE.n.z, vE.t.x, vE.t.y,
-            vF.p.x, vF.p.y, vF.p.z, vF.p.w, vF.c.r, vF.c.g, vF.c.b, vF.c.a,
-            vF.n.x, vF.n.y, vF.n.z, vF.t.x, vF.t.y
-        ]
+        gl.glBufferData(
+            gl.GL_ARRAY_BUFFER,
+            SIM_INSTANCES_PER_BATCH * SIM_INSTANCE_SIZE,
+            None,
+            gl.GL_STREAM_DRAW
+        )
+
+        # the instance attributes advance once per instance, the divisors are
+        # part of the vao so they don't leak into the mesh batches
+        locs = attrib_locations(gl, shader)
+        # (location, size, offset) of the per instance attributes
+        self.inst_attribs = []
+        self.first = 0
+        self.vao = gl.glGenVertexArrays(1)
+        gl.glBindVertexArray(self.vao)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.mesh_vbo)
+        if locs.get('position', -1) >= 0:
+            gl.glVertexAttribPointer(locs['position'], 2, gl.GL_FLOAT, False,
+                    0, ctypes.c_void_p(0))
+            gl.glEnableVertexAttribArray(locs['position'])
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vbo)
+        for name, size, offset in [
+                ('inst_center', 2, 0),
+                ('inst_scale', 2, 8),
+                ('inst_rotation', 1, 16),
+                ('inst_color', 4, 20)]:
+            loc = locs.get(name, -1)
+            if loc >= 0:
+                gl.glVertexAttribPointer(loc, size, gl.GL_FLOAT, False,
+                        SIM_INSTANCE_SIZE, ctypes.c_void_p(offset))
+                gl.glEnableVertexAttribArray(loc)
+                gl.glVertexAttribDivisor(loc, 1)
+                self.inst_attribs.append((loc, size, offset))
+        gl.glBindVertexArray(0)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+
+    # - centers and scales are arrays of shape (N, 2)
+    # - rotations is an array of shape (N,), in radians
+    # - color is a single color or an array of shape (N, 4), in the same range
+    # as the colors given to Vert
+    def add_instances(self, centers, scales, rotations, color):
+        color = np.asarray(color, dtype=np.float32) / 255
+        inst_cnt = len(centers)
+        done = 0
+        while done < inst_cnt:
+            if self.count == SIM_INSTANCES_PER_BATCH:
+                (self.flush_fn or self.draw)()
+            start = self.count
+            cnt = min(inst_cnt - done, SIM_INSTANCES_PER_BATCH - start)
+            self.data[start:start + cnt, 0:2] = centers[done:done + cnt]
+            self.data[start:start + cnt, 2:4] = scales[done:done + cnt]
+            self.data[start:start + cnt, 4] = rotations[done:done + cnt]
+            if color.ndim == 1:
+                self.data[start:start + cnt, 5:9] = color
+            else:
+                self.data[start:start + cnt, 5:9] = color[done:done + cnt]
+            self.count += cnt
+            done += cnt
 
-        line = np.array(line, dtype=np.float32)
+    def draw(self):
+        if self.count == 0:
+            return
+        self.gl.glUseProgram(self.shader)
+        self.upload()
+        self.draw_range(0, self.count)
+        self.count = 0
 
+    def upload(self):
+        gl = self.gl
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vbo)
+        # orphan the old storage, the last instanced draw may still read it
+        gl.glBufferData(gl.GL_ARRAY_BUFFER,
+                SIM_INSTANCES_PER_BATCH * SIM_INSTANCE_SIZE, None,
+                gl.GL_STREAM_DRAW)
         gl.glBufferSubData(
             gl.GL_ARRAY_BUFFER,
-            SIM_LINE_SIZE * self.count,
-            line.nbytes,
-            line)
+            0,
+            self.count * SIM_INSTANCE_SIZE,
+            self.data[:self.count])
         gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
-        self.count += 1
+        frame_stats.upload_bytes += self.count * SIM_INSTANCE_SIZE
 
-    def draw(self):
-        if self.count > 0:
-            gl = self.gl
-            self.bind_shader(self.shader)
-            gl.glDrawArrays(gl.GL_LINES, 0, 2 * self.count)
-            self.count = 0
+    # draws the instances from first to first + count, the program must be in
+    # use, without base instances (gl 4.2) the instance attributes are moved
+    # to start at first
+    def draw_range(self, first, count):
+        gl = self.gl
+        gl.glBindVertexArray(self.vao)
+        if first != self.first:
+            gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vbo)
+            for loc, size, offset in self.inst_attribs:
+                gl.glVertexAttribPointer(loc, size, gl.GL_FLOAT, False,
+                        SIM_INSTANCE_SIZE,
+                        ctypes.c_void_p(first * SIM_INSTANCE_SIZE + offset))
+            gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+            self.first = first
+        gl.glDrawArraysInstanced(self.primitive, 0, self.mesh_vert_cnt, count)
+        gl.glBindVertexArray(0)
+        frame_stats.add_draw(gl, self.primitive, [self.mesh_vert_cnt], count)
+        frame_stats.instances += count
+
+    # returns the (min, max) corners of the instances in each [start, end)
+    # range, like MeshBatch.bounds, in the units of the instance centers
+    def bounds(self, starts, ends):
+        data = self.data[:ends[-1]]
+        radius = np.abs(data[:, 2:4]).max(axis=1, keepdims=True) * \
+                self.mesh_radius
+        return (np.minimum.reduceat(data[:, 0:2] - radius, starts),
+                np.maximum.reduceat(data[:, 0:2] + radius, starts))
+
+# a dict that holds at most `capacity` items, when full the least recently used
+# item is dropped
+class LRUCache:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        value = self.items.get(key, default)
+        if value is default:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.capacity:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
 
 # font must be a monospace font, we don't support other types of fonts
 class SimFont:
@@ -147,9 +709,545 @@ class SimFont:
         self.font_name = font_name
         self.font_size = font_size
         self.font = pygame.freetype.Font(font_name, font_size)
+        self._char_width = self.font.get_rect(' ').width
+        self._char_height = self.font.get_sized_height()
+        self._char_rects = {}
 
     def char_width_px(self):
-        return self.font.get_rect(' ').width
+        return self._char_width
 
     def char_height_px(self):
-        return self.font.get_sized_height()
+        return self._char_height
+
+    # returns the same rect as font.get_rect(text), built from the cached rects
+    # of each char, this only works because the font is monospace
+    def get_rect(self, text):
+        if not text:
+            return self.font.get_rect(text)
+        rects = self._char_rects
+        left = right = top = bottom = None
+        for i, ch in enumerate(text):
+            r = rects.get(ch)
+            if r is None:
+                r = self.font.get_rect(ch)
+                rects[ch] = r
+            x = i * self._char_width + r.x
+            if left is None:
+                left, right, top, bottom = x, x + r.width, r.y, r.y - r.height
+            else:
+                left = min(left, x)
+                right = max(right, x + r.width)
+                top = max(top, r.y)
+                bottom = min(bottom, r.y - r.height)
+        return pygame.Rect(left, top, right - left, top - bottom)
+
+# A GlyphAtlas keeps the glyphs of a SimFont in an opengl texture, so text can
+# be drawn as textured quads. Because the font is monospace each glyph gets a
+# cell of the same size in a grid.
+# - the glyphs are white, the shader must multiply them with the text color
+# - chars outside [SIM_ATLAS_FIRST_CHAR, SIM_ATLAS_LAST_CHAR] are drawn as '?'
+SIM_ATLAS_FIRST_CHAR = 32
+SIM_ATLAS_LAST_CHAR = 255
+SIM_ATLAS_COLUMNS = 16
+# empty pixels around each glyph, for glyphs that leave their cell
+SIM_ATLAS_PAD = 2
+
+# the corners of the two triangles of a quad, in [0, 1]x[0, 1]
+_QUAD_CORNERS = np.array([[0, 0], [1, 0], [1, 1], [1, 1], [0, 1], [0, 0]],
+        dtype=np.float32)
+
+class GlyphAtlas:
+    def __init__(self, font_obj, gl=None):
+        if not gl:
+            raise Exception("Can't use glyph atlas without opengl")
+        self.gl = gl
+        font = font_obj.font
+        pad = SIM_ATLAS_PAD
+        self.advance = font_obj.char_width_px()
+        self.ascender = font.get_sized_ascender()
+        self.cell_w = self.advance + 2 * pad
+        self.cell_h = font_obj.char_height_px() + 2 * pad
+        char_cnt = SIM_ATLAS_LAST_CHAR - SIM_ATLAS_FIRST_CHAR + 1
+        rows = (char_cnt + SIM_ATLAS_COLUMNS - 1) // SIM_ATLAS_COLUMNS
+        self.width = SIM_ATLAS_COLUMNS * self.cell_w
+        self.height = rows * self.cell_h
+
+        surf = pygame.Surface((self.width, self.height), pygame.SRCALPHA)
+        surf.fill((255, 255, 255, 0))
+        for i in range(char_cnt):
+            ch = chr(SIM_ATLAS_FIRST_CHAR + i)
+            rect = font.get_rect(ch)
+            if rect.width == 0:
+                continue
+            row, col = divmod(i, SIM_ATLAS_COLUMNS)
+            x = col * self.cell_w + pad + rect.x
+            y = row * self.cell_h + pad + self.ascender - rect.y
+            font.render_to(surf, (x, y), ch, fgcolor=(255, 255, 255, 255))
+
+        # the cell of each latin-1 code
+        self.cell_of = np.full(256, ord('?') - SIM_ATLAS_FIRST_CHAR, dtype=int)
+        self.cell_of[SIM_ATLAS_FIRST_CHAR:SIM_ATLAS_LAST_CHAR + 1] = \
+                np.arange(char_cnt)
+
+        self.texture = gl.glGenTextures(1)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER,
+                gl.GL_NEAREST)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER,
+                gl.GL_NEAREST)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S,
+                gl.GL_CLAMP_TO_EDGE)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T,
+                gl.GL_CLAMP_TO_EDGE)
+        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA8, self.width,
+                self.height, 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE,
+                pygame.image.tostring(surf, "RGBA", False))
+        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+
+    # returns the quads of the glyphs of `text` as (pos, uv), two arrays of
+    # shape (len(text) * 6, 2)
+    # - pos is in pixels, relative to the start of the baseline of the text
+    # - uv are the texture coordinates, from the top-left of the atlas
+    def layout(self, text):
+        codes = np.frombuffer(text.encode('latin-1', 'replace'),
+                dtype=np.uint8)
+        cells = self.cell_of[codes]
+        rows, cols = np.divmod(cells, SIM_ATLAS_COLUMNS)
+        pos = np.empty((len(cells), 6, 2), dtype=np.float32)
+        pos[:, :, 0] = (np.arange(len(cells)) * self.advance -
+                SIM_ATLAS_PAD)[:, None] + _QUAD_CORNERS[:, 0] * self.cell_w
+        pos[:, :, 1] = -self.ascender - SIM_ATLAS_PAD +\
+                _QUAD_CORNERS[:, 1] * self.cell_h
+        uv = np.empty((len(cells), 6, 2), dtype=np.float32)
+        uv[:, :, 0] = (cols[:, None] + _QUAD_CORNERS[:, 0]) *\
+                (self.cell_w / self.width)
+        uv[:, :, 1] = (rows[:, None] + _QUAD_CORNERS[:, 1]) *\
+                (self.cell_h / self.height)
+        return pos.reshape(-1, 2), uv.reshape(-1, 2)
+
+# the number of textures of dead surfaces kept around for new surfaces
+SIM_FREE_TEXTURES = 16
+
+# SurfaceTextures keeps an opengl texture for each pygame surface that is drawn,
+# so a surface is only sent to the gpu again when it's pixels change.
+# - the pixels are compared by a checksum of the surface memory, the surfaces
+# don't need to be marked as changed and nothing is copied when they didn't
+# - the textures of the surfaces that are gone are given to new surfaces
+# - a texture that was given out by `get` is not written again until `drawn`
+# is called, flush_fn is called first to draw everything that uses it
+class SurfaceTextures:
+    def __init__(self, gl=None):
+        if not gl:
+            raise Exception("Can't use surface textures without opengl")
+        self.gl = gl
+        # id(surface) -> [weakref, texture, size, checksum]
+        self.entries = {}
+        self.free = []
+        self.in_use = set()
+        self.flush_fn = None
+        # the pixels go through a pixel buffer, so the copy to the texture
+        # doesn't stall the cpu
+        self.pbo = gl.glGenBuffers(1)
+
+    # returns the texture with the pixels of surface, the rows start from the
+    # top of the surface
+    def get(self, surface):
+        entry = self.entries.get(id(surface))
+        if entry is None:
+            key = id(surface)
+            ref = weakref.ref(surface, lambda ref: self._surface_gone(key))
+            entry = [ref, self._new_texture(), None, None]
+            self.entries[id(surface)] = entry
+        size = surface.get_size()
+        buffer = surface.get_buffer()
+        # the colorkey changes the alpha of the texture, not the memory
+        checksum = (zlib.crc32(buffer), surface.get_colorkey())
+        if entry[2] != size or entry[3] != checksum:
+            if entry[1] in self.in_use and self.flush_fn:
+                self.flush_fn()
+            data, fmt = self._pixels(surface, buffer)
+            self._upload(entry[1], size, data, fmt, entry[2] != size)
+            entry[2] = size
+            entry[3] = checksum
+        self.in_use.add(entry[1])
+        return entry[1]
+
+    # the textures given by `get` were drawn, they can be written again, except
+    # for `keep`
+    def drawn(self, keep=0):
+        self.in_use.clear()
+        if keep:
+            self.in_use.add(keep)
+
+    # the raw pixels of the surface and their gl format, buffer is the memory
+    # of the surface, used without a copy for the usual 32 bit surfaces with
+    # alpha
+    def _pixels(self, surface, buffer):
+        gl = self.gl
+        if surface.get_flags() & pygame.SRCALPHA and \
+                surface.get_bitsize() == 32 and \
+                surface.get_pitch() == surface.get_width() * 4 and \
+                surface.get_masks() == (0xff0000, 0xff00, 0xff, 0xff000000):
+            return buffer, gl.GL_BGRA
+        if surface.get_colorkey() is not None:
+            return pygame.image.tostring(surface, "RGBA", False), gl.GL_RGBA
+        # opaque, the alpha pygame gives for surfaces without one is not
+        # always 255
+        return pygame.image.tostring(surface, "RGB", False), gl.GL_RGB
+
+    def _upload(self, texture, size, data, fmt, resize):
+        gl = self.gl
+        nbytes = size[0] * size[1] * (3 if fmt == gl.GL_RGB else 4)
+        gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, self.pbo)
+        # orphan the old storage, an upload may still read from it
+        gl.glBufferData(gl.GL_PIXEL_UNPACK_BUFFER, nbytes, None,
+                gl.GL_STREAM_DRAW)
+        gl.glBufferSubData(gl.GL_PIXEL_UNPACK_BUFFER, 0, nbytes,
+                np.frombuffer(data, dtype=np.uint8))
+        gl.glBindTexture(gl.GL_TEXTURE_2D, texture)
+        # the rows of rgb pixels are not aligned to 4 bytes
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        if resize:
+            gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA8, size[0], size[1],
+                    0, fmt, gl.GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        else:
+            gl.glTexSubImage2D(gl.GL_TEXTURE_2D, 0, 0, 0, size[0], size[1],
+                    fmt, gl.GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 4)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+        frame_stats.texture_uploads += 1
+        frame_stats.upload_bytes += nbytes
+
+    def _new_texture(self):
+        gl = self.gl
+        # a texture that was used by a dead surface may still be drawn
+        while len(self.free) > SIM_FREE_TEXTURES:
+            texture = self.free.pop(0)
+            if texture in self.in_use and self.flush_fn:
+                self.flush_fn()
+            gl.glDeleteTextures(1, [texture])
+        if self.free:
+            return self.free.pop()
+        texture = gl.glGenTextures(1)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, texture)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER,
+                gl.GL_NEAREST)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER,
+                gl.GL_NEAREST)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S,
+                gl.GL_CLAMP_TO_EDGE)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T,
+                gl.GL_CLAMP_TO_EDGE)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        return texture
+
+    # called by the weakref of a surface, no gl calls can be made here, this
+    # can run at any time
+    def _surface_gone(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.free.append(entry[1])
+
+# what FrameCapture does when the writer can't keep up with the frames
+CAPTURE_BLOCK = 0   # wait for the writer, the frame rate drops
+CAPTURE_DROP = 1    # skip the frame, the video will have gaps
+
+# saves the frames to `out_dir` from a writer thread, so the render loop only
+# pays for reading the pixels:
+# - fmt 'png' writes one frame_XXXXXX.png per frame
+# - fmt 'raw' appends rgb24 frames to frames.rgb, it can be encoded with
+# ffmpeg -f rawvideo -pix_fmt rgb24 -s WxH -i frames.rgb out.mp4
+# - with opengl the pixels are read into pixel buffer objects and fetched one
+# frame later, so the read doesn't wait for the gpu to finish the frame
+# - if the writer fails the error is kept in `error` and the next frames are
+# dropped, the caller raises it when the capture is closed
+class FrameCapture:
+    def __init__(self, out_dir, width, height, fmt='png', max_queue=16,
+            policy=CAPTURE_BLOCK, gl=None, pbo_count=2):
+        if fmt not in ('png', 'raw'):
+            raise Exception("Unknown capture format: %s" % fmt)
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.width = width
+        self.height = height
+        self.fmt = fmt
+        self.policy = policy
+        self.gl = gl
+        self.frame_cnt = 0
+        self.dropped = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.raw_file = None
+        if fmt == 'raw':
+            self.raw_file = open(os.path.join(out_dir, 'frames.rgb'), 'wb')
+        self.pbos = []
+        self.pending = []
+        if gl:
+            self.pbos = [gl.glGenBuffers(1) for i in range(pbo_count)]
+            for pbo in self.pbos:
+                gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, pbo)
+                gl.glBufferData(gl.GL_PIXEL_PACK_BUFFER, width * height * 3,
+                        None, gl.GL_STREAM_READ)
+            gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        self.writer = threading.Thread(target=self._write_frames, daemon=True)
+        self.writer.start()
+
+    # call after the frame was drawn and before it is presented
+    def grab(self, surface=None):
+        gl = self.gl
+        if not gl:
+            self._push(pygame.image.tobytes(surface, 'RGB'), False)
+        else:
+            pbo = self.pbos[self.frame_cnt % len(self.pbos)]
+            gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, pbo)
+            # the buffer still holds the oldest frame in flight, fetch it first
+            if len(self.pending) == len(self.pbos):
+                self._fetch(self.pending.pop(0))
+            gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+            gl.glReadPixels(0, 0, self.width, self.height, gl.GL_RGB,
+                    gl.GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+            gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+            self.pending.append(pbo)
+        self.frame_cnt += 1
+
+    # writes the frames still in flight and waits for the writer to finish
+    def close(self):
+        gl = self.gl
+        for pbo in self.pending:
+            gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, pbo)
+            self._fetch(pbo)
+        self.pending = []
+        if gl:
+            gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+            gl.glDeleteBuffers(len(self.pbos), self.pbos)
+            self.pbos = []
+        self._put(None)
+        self.writer.join()
+        if self.raw_file:
+            self.raw_file.close()
+
+    # the pbo must be bound
+    def _fetch(self, pbo):
+        gl = self.gl
+        data = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        gl.glGetBufferSubData(gl.GL_PIXEL_PACK_BUFFER, 0, data.nbytes, data)
+        self._push(data, True)
+
+    def _push(self, data, flipped):
+        if self.error:
+            self.dropped += 1
+        elif self.policy == CAPTURE_DROP:
+            try:
+                self.queue.put_nowait((data, flipped))
+            except queue.Full:
+                self.dropped += 1
+        elif not self._put((data, flipped)):
+            self.dropped += 1
+
+    # waits for room in the queue as long as the writer is alive, a writer that
+    # failed doesn't empty the queue anymore, returns False if it is gone
+    def _put(self, item):
+        while self.writer.is_alive():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _write_frames(self):
+        try:
+            self._write_queue()
+        except Exception as e:
+            self.error = e
+
+    def _write_queue(self):
+        index = 0
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            data, flipped = item
+            if flipped:
+                # opengl has the first row at the bottom
+                data = np.ascontiguousarray(data[::-1]).tobytes()
+            if self.raw_file:
+                self.raw_file.write(data)
+            else:
+                surf = pygame.image.frombytes(data, (self.width, self.height),
+                        'RGB')
+                pygame.image.save(surf, os.path.join(self.out_dir,
+                        'frame_%06d.png' % index))
+            index += 1
+
+# Profiler keeps the time spent in named scopes for the last `frames` frames,
+# the times of a scope that is entered many times in a frame are added:
+# - `scope` is used around each part of the frame, scopes can be nested
+# - `end_frame` must be called once at the end of each frame
+# - `start_trace` records every scope of the next n frames and writes them to a
+# json file that chrome://tracing or https://ui.perfetto.dev can open
+class Profiler:
+    def __init__(self, frames=SIM_PROFILE_FRAMES):
+        self.frames = frames
+        # name -> the time spent in the scope in each of the last frames
+        self.history = {}
+        self._frame = {}
+        self._trace_path = None
+        self._trace_left = 0
+        self._trace_events = []
+        self._t0 = time.perf_counter()
+
+    @contextlib.contextmanager
+    def scope(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - start
+            self._frame[name] = self._frame.get(name, 0) + dt
+            if self._trace_left:
+                self._trace_events.append((name, start, dt))
+
+    def end_frame(self):
+        frame = self._frame
+        self._frame = {}
+        for name, dt in frame.items():
+            if name not in self.history:
+                self.history[name] = collections.deque(maxlen=self.frames)
+            self.history[name].append(dt)
+        # the scopes that were not entered this frame took no time
+        for name, times in self.history.items():
+            if name not in frame:
+                times.append(0)
+        if self._trace_left:
+            self._trace_left -= 1
+            if not self._trace_left:
+                self._write_trace()
+
+    # returns {name: (last, avg, max)}, in seconds
+    def stats(self):
+        return {name: (times[-1], sum(times) / len(times), max(times))
+                for name, times in self.history.items()}
+
+    def start_trace(self, path, frames):
+        if self._trace_left:
+            raise Exception("A trace is already running")
+        self._trace_path = path
+        self._trace_left = frames
+        self._trace_events = []
+
+    def _write_trace(self):
+        events = [{
+            'name': name,
+            'ph': 'X',
+            'ts': (start - self._t0) * 1e6,
+            'dur': dt * 1e6,
+            'pid': 0,
+            'tid': 0
+        } for name, start, dt in self._trace_events]
+        self._trace_events = []
+        with open(self._trace_path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+# GpuTimer measures the time the gpu spends on the commands between `begin` and
+# `end` with timer queries, the results are read when they are ready, one or
+# two frames later, so the cpu never waits for the gpu
+class GpuTimer:
+    def __init__(self, gl=None, queries=SIM_GPU_TIMER_QUERIES):
+        if not gl:
+            raise Exception("Can't use gpu timer without opengl")
+        self.gl = gl
+        self.free = list(gl.glGenQueries(queries))
+        # the queries that were ended and are not read yet, oldest first
+        self.pending = collections.deque()
+        self.active = None
+        # the time of the last frame that was read, in seconds
+        self.last = None
+        # the pyopengl wrapper has no numpy type for the 64 bit result, the
+        # raw function writes it in a ctypes integer
+        from OpenGL.raw.GL.VERSION.GL_3_3 import glGetQueryObjectui64v
+        self._get_result = glGetQueryObjectui64v
+        self._result = ctypes.c_uint64(0)
+
+    def begin(self):
+        # too many frames in flight, this one is not timed
+        if self.active is not None or not self.free:
+            return
+        self.active = self.free.pop()
+        self.gl.glBeginQuery(self.gl.GL_TIME_ELAPSED, self.active)
+
+    # returns the time of the newest frame that is ready, which is not this one
+    def end(self):
+        gl = self.gl
+        if self.active is not None:
+            gl.glEndQuery(gl.GL_TIME_ELAPSED)
+            self.pending.append(self.active)
+            self.active = None
+        while self.pending:
+            query = self.pending[0]
+            if not gl.glGetQueryObjectiv(query, gl.GL_QUERY_RESULT_AVAILABLE):
+                break
+            self._get_result(query, gl.GL_QUERY_RESULT,
+                    ctypes.byref(self._result))
+            self.last = self._result.value / 1e9
+            self.free.append(self.pending.popleft())
+        return self.last
+
+# EventRecorder writes the pygame events of each frame and the real time the
+# frame took to a gzipped file of json lines, EventReplay reads them back frame
+# by frame. The first line is a header with `version` and whatever the
+# recorder was given, each line after that is a frame, [dt] or [dt, events],
+# with events as [type, attributes] pairs.
+class EventRecorder:
+    def __init__(self, path, header):
+        self.file = gzip.open(path, 'wt')
+        self.file.write(json.dumps(dict(header, version=SIM_EVENTS_VERSION)) +
+                '\n')
+        self.events = []
+        self.frames = 0
+
+    def add(self, events):
+        for event in events:
+            # the attributes that can't be saved (like the window of the
+            # event) are left out
+            attrs = {k: v for k, v in event.dict.items()
+                    if isinstance(v, (int, float, str, tuple, list))
+                    or v is None}
+            self.events.append([event.type, attrs])
+
+    def end_frame(self, dt):
+        # not rounded, the replay must do the same clock ticks
+        frame = [dt]
+        if self.events:
+            frame.append(self.events)
+            self.events = []
+        self.file.write(json.dumps(frame, separators=(',', ':')) + '\n')
+        self.frames += 1
+
+    def close(self):
+        self.file.close()
+
+class EventReplay:
+    def __init__(self, path):
+        with gzip.open(path, 'rt') as f:
+            self.header = json.loads(f.readline())
+            if self.header.get('version') != SIM_EVENTS_VERSION:
+                raise Exception("Unknown event recording version: %s" %
+                        self.header.get('version'))
+            self.frames = [line for line in f if line.strip()]
+        self.index = 0
+
+    # returns (dt, events) for the next frame, None after the last one
+    def next_frame(self):
+        if self.index == len(self.frames):
+            return None
+        frame = json.loads(self.frames[self.index])
+        self.index += 1
+        events = []
+        for event_type, attrs in (frame[1] if len(frame) > 1 else []):
+            # json gives lists back for the tuples, like the positions
+            attrs = {k: tuple(v) if isinstance(v, list) else v
+                    for k, v in attrs.items()}
+            events.append(pygame.event.Event(event_type, attrs))
+        return frame[0], events
@@ -20,11 +20,13 @@ in vec4 color;
 in vec3 normal;
 in vec2 tex_uv;
 
+uniform mat4 view;
+
 out vec4 vert_color;
 out vec4 vert_pos;
 
 void main() {
-    gl_Position = position;
+    gl_Position = view * position;
     vert_color = color;
     vert_pos = position;
 }
@@ -37,12 +39,11 @@ in vec4 vert_pos;
 in vec4 vert_color;
 out vec4 frag_color;
 
-uniform float scale;
 uniform vec2 mouse_pos;
 
 void main() {
-    float x = vert_pos.x * scale;
-    float y = vert_pos.y * scale;
+    float x = vert_pos.x;
+    float y = vert_pos.y;
     vec2 mdir = vec2(x, y) - mouse_pos;
     vec2 mdir_norm = normalize(mdir);
     float grid_size = 2;
@@ -70,8 +71,6 @@ void main() {
 }
 """
 
-gl = sim.state.gl
-
 test_shader = sim.create_shader(VERTEX_SHADER, FRAGMENT_SHADER)
 fps = utils.FpsCounter()
 
@@ -82,16 +81,10 @@ def draw_axis():
     sim.draw_line([0, 0], [0,-s], Color.GREEN)
     sim.draw_line([0, 0], [-s,0], Color.BLACK)
 
-def set_uniform(shader, fn, name, *vals):
-    uniform_loc = gl.glGetUniformLocation(shader, name)
-    fn(uniform_loc, *vals)
-
 def draw_fn():
     draw_axis()
     sim.use_shader(test_shader)
-    set_uniform(test_shader, gl.glUniform1f, 'scale', s)
-    mp = sim.get_mouse_pos()
-    set_uniform(test_shader, gl.glUniform2f, 'mouse_pos', mp.x, mp.y)
+    test_shader.set('mouse_pos', sim.get_mouse_pos())
     sim.draw_aabb([-s, -s], [s, s], Color.WHITE, filled=True)
 
 sim.loop(draw_fn=draw_fn)
@@ -49,7 +49,7 @@ class TextLine:
         else:
             self.font_obj = font_obj
         self.rotated = rotated
-        self.A_rect = self.font_obj.font.get_rect('A')
+        self.A_rect = self.font_obj.get_rect('A')
 
     def draw(self):
         text_width = self.font_obj.char_width_px() * len(self.text)
@@ -64,7 +64,7 @@ class TextLine:
                 ymod -= text_width
             if self.align[0] == XRIGHT:
                 xmod -= text_height
-            text_surf, rect = self.font_obj.font.render(self.text, self.color)
+            rect = self.font_obj.get_rect(self.text)
             if self.align[0] == XCENTER:
                 xmod -= rect.height // 2
             else:
@@ -80,7 +80,7 @@ class TextLine:
                 pass
             elif self.align[1] == YBOTTOM:
                 ymod -= text_height
-            text_surf, rect = self.font_obj.font.render(self.text, self.color)
+            rect = self.font_obj.get_rect(self.text)
             if self.align[1] == YCENTER:
                 ymod -= rect.height // 2
             else:
@@ -91,9 +91,11 @@ class TextLine:
             raise Exception(
                     "Negative position for text is not allowed(check align)")
         if self.rotated:
-            sim.draw_surf(pos_px, text_surf, rotate=90)
+            sim.draw_text(pos_px, self.text, self.font_obj, self.color,
+                    rotate=90)
         else:
-            sim.draw_surf(pos_px, text_surf, rotate=0)
+            sim.draw_text(pos_px, self.text, self.font_obj, self.color,
+                    rotate=0)
 
     # def _draw_axis(self, pos_px, text_width):
     #     old_px = (pos_px[0], pos_px[1])
@@ -119,11 +121,9 @@ class TextBlock:
         else:
             raise Exception("Can't draw text with no position")
         if limits:
-            self.limits = limits
+            self.limits_px = (sim.dist2px(limits[0]), sim.dist2px(limits[1]))
         elif limits_px:
             self.limits_px = limits_px
-        elif limits:
-            self.limits_px = (sim.dist2px(limits[0]), sim.dist2px(limits[1]))
         else:
             self.limits_px = (10000, 10000)
         self.text = text
@@ -134,14 +134,24 @@ class TextBlock:
             self.font_obj = sim.load_font_size(font_size)
         else:
             self.font_obj = font_obj
+        self._lines = []
+        self._layout_key = None
+
+    # the wrapped lines are only rebuilt when something they depend on changes
+    def _layout(self):
+        key = (self.text, tuple(self.limits_px), tuple(self.pos_px),
+                self.xalign, tuple(self.color), self.font_obj)
+        if key == self._layout_key:
+            return self._lines
+        self._layout_key = key
+        self._lines = []
 
-    def draw(self):
         max_col_cnt = int(self.limits_px[0] / self.font_obj.char_width_px())
         if max_col_cnt == 0:
-            return
+            return self._lines
         max_row_cnt = int(self.limits_px[1] / self.font_obj.char_height_px())
         if max_row_cnt == 0:
-            return
+            return self._lines
 
         # https://stackoverflow.com/questions/1166317/
         drawtext = '\n'.join(['\n'.join(textwrap.wrap(line, width=max_col_cnt,
@@ -157,9 +167,14 @@ class TextBlock:
         if self.xalign == XRIGHT:
             xpos += self.limits_px[0]
         for d in drawtext:
-            tl = TextLine(d, pos_px=(xpos, pos_y), color=self.color,
-                    font_obj=self.font_obj, align=(self.xalign, YTOP))
+            self._lines.append(TextLine(d, pos_px=(xpos, pos_y),
+                    color=self.color, font_obj=self.font_obj,
+                    align=(self.xalign, YTOP)))
             pos_y += self.font_obj.char_height_px()
+        return self._lines
+
+    def draw(self):
+        for tl in self._layout():
             tl.draw()
 
 class Button(interactive.Interactive):
@@ -1,23 +1,94 @@
 import time
 import numpy as np
 
+# FrameTimes keeps the duration of the last `size` frames in a ring, for the
+# stutter an average hides:
+# - call `update` once per frame, or `add` with a time you measured yourself
+# - budget is the time a frame should take, in seconds, the frames that take
+# longer are counted in over_budget
+# - the statistics are only computed when asked for, recording a frame is
+# cheap enough to always leave on
+class FrameTimes:
+    def __init__(self, size=1024, budget=1/60):
+        self.times = np.zeros(size)
+        self.size = size
+        self.budget = budget
+        # all the frames recorded and the ones over budget, not only the kept
+        # ones
+        self.count = 0
+        self.over_budget = 0
+        self.last_time = None
+
+    # returns the time since the last call, None on the first call
+    def update(self):
+        now = time.perf_counter()
+        dt = None
+        if self.last_time is not None:
+            dt = now - self.last_time
+            self.add(dt)
+        self.last_time = now
+        return dt
+
+    def add(self, dt):
+        self.times[self.count % self.size] = dt
+        self.count += 1
+        if dt > self.budget:
+            self.over_budget += 1
+
+    # the kept frame times, not in order once the ring wrapped around
+    def recent(self):
+        return self.times[:min(self.count, self.size)]
+
+    def percentile(self, p):
+        times = self.recent()
+        if len(times) == 0:
+            return 0
+        return float(np.percentile(times, p))
+
+    # returns a dict with the p50, p95, p99, max and mean frame times, in
+    # seconds, and the number of frames over budget, all of them over the kept
+    # frames, None if there are none
+    def stats(self):
+        times = self.recent()
+        if len(times) == 0:
+            return None
+        p50, p95, p99 = np.percentile(times, [50, 95, 99])
+        return {
+            'p50': float(p50),
+            'p95': float(p95),
+            'p99': float(p99),
+            'max': float(times.max()),
+            'mean': float(times.mean()),
+            'over_budget': int((times > self.budget).sum())
+        }
+
+    # returns (counts, edges) of the kept frame times, as np.histogram
+    def histogram(self, bins=20):
+        return np.histogram(self.recent(), bins=bins)
+
 # if you don't want to count frames per second you can choose another interval
+# - frame_times records the time between the updates, for their percentiles
 class FpsCounter:
-    def __init__(self, update_interval_sec=None):
+    def __init__(self, update_interval_sec=None, budget=1/60):
         self.started = False
         self.update_interval = update_interval_sec if update_interval_sec else 1
-        
+        self.frame_times = FrameTimes(budget=budget)
+
     def start(self):
-        self.last_time = time.time()
+        self.last_time = time.perf_counter()
         self.curr_cnt = 0
         self.fps = 0
         self.started = True
+        self.frame_times.last_time = self.last_time
 
     def update(self):
         if not self.started:
             self.start()
+            # there is no frame before this one to time
+            self.frame_times.last_time = None
         self.curr_cnt += 1
-        curr_time = time.time()
+        self.frame_times.update()
+        curr_time = self.frame_times.last_time
         if curr_time - self.last_time > self.update_interval:
             self.fps = self.curr_cnt / ((curr_time - self.last_time) /\
                     self.update_interval)
@@ -28,3 +99,7 @@ class FpsCounter:
 
     def get_fps(self):
         return self.fps
+
+    # see FrameTimes.stats
+    def get_stats(self):
+        return self.frame_times.stats()